@@ -0,0 +1,68 @@
+import os
+
+import numpy as np
+import pytest
+
+from xmcd_projection import Mesh
+from xmcd_projection.bvh import BVH
+
+EXAMPLES = os.path.join(os.path.dirname(__file__), '..', 'examples')
+
+
+@pytest.fixture(scope='module')
+def mesh():
+    return Mesh.from_file(os.path.join(EXAMPLES, 'example_mesh.msh'))
+
+
+@pytest.fixture(scope='module')
+def mumax_mesh():
+    # the faces of the cubes are flat along the axes, so their boxes have zero thickness
+    return Mesh.from_file(os.path.join(EXAMPLES, 'mumax_mesh.vtu'), scale=1e9)
+
+
+def get_ray_origins(mesh):
+    """Origins of the rays through the vertices of the mesh, hitting the triangles at their vertices and edges, and through the face centres.
+    """
+    rng = np.random.default_rng(0)
+    vertices = mesh.points[rng.choice(mesh.points.shape[0], 200, replace=False)]
+    centres = mesh.triangles[rng.choice(mesh.faces.shape[0], 200, replace=False)].mean(axis=1)
+    return np.vstack([vertices, centres])
+
+
+def sorted_hits(hits):
+    index_ray, index_tri, t = hits
+    order = np.lexsort((index_tri, index_ray))
+    return index_ray[order], index_tri[order], t[order]
+
+
+def assert_same_hits(hits, expected):
+    hits, expected = sorted_hits(hits), sorted_hits(expected)
+    np.testing.assert_array_equal(hits[0], expected[0])
+    np.testing.assert_array_equal(hits[1], expected[1])
+    np.testing.assert_allclose(hits[2], expected[2])
+
+
+@pytest.mark.parametrize('mesh_name', ['mesh', 'mumax_mesh'])
+@pytest.mark.parametrize('direction', [[1, 2, 3], [0, 0, 1], [0, 1, 1]])
+def test_bvh_finds_all_the_hits(mesh_name, direction, request):
+    mesh = request.getfixturevalue(mesh_name)
+    ray_origins = get_ray_origins(mesh)
+    direction = np.array(direction) / np.linalg.norm(direction)
+    # a single leaf tests all the triangles
+    brute_force = BVH(mesh.points, mesh.faces, leaf_size=mesh.faces.shape[0])
+    expected = brute_force.intersect(ray_origins, direction)
+    assert_same_hits(mesh.bvh.intersect(ray_origins, direction), expected)
+    compact = BVH(mesh.points, mesh.faces, bounds_dtype=np.float32)
+    assert_same_hits(compact.intersect(ray_origins, direction), expected)
+
+
+def test_bvh_save_load(mesh, tmp_path):
+    ray_origins = get_ray_origins(mesh)
+    direction = np.array([1, 2, 3]) / np.sqrt(14)
+    mesh.bvh.save(str(tmp_path / 'bvh'))
+    loaded = BVH.load(str(tmp_path / 'bvh'))
+    assert loaded.leaf_size == mesh.bvh.leaf_size
+    for name in ('points', 'faces', 'node_lo', 'node_hi', 'order'):
+        np.testing.assert_array_equal(getattr(loaded, name), getattr(mesh.bvh, name))
+    assert_same_hits(loaded.intersect(ray_origins, direction),
+                     mesh.bvh.intersect(ray_origins, direction))
@@ -0,0 +1,39 @@
+import os
+import time
+
+import numpy as np
+import pytest
+
+from xmcd_projection import Mesh, PiercingsCache, RayTracing, get_projection_vector
+
+EXAMPLES = os.path.join(os.path.dirname(__file__), '..', 'examples')
+
+
+@pytest.fixture(scope='module')
+def mesh():
+    return Mesh.from_file(os.path.join(EXAMPLES, 'example_mesh.msh'))
+
+
+def test_cache_hit_gives_the_same_piercings(mesh, tmp_path):
+    p = get_projection_vector(90, 16)
+    traced = RayTracing(mesh, p, cache=str(tmp_path))
+    traced_matrix = traced.piercings_matrix
+    assert len([name for name in os.listdir(tmp_path) if name.endswith('.npz')]) == 1
+    cached = RayTracing(mesh, p, cache=str(tmp_path))
+    cached.trace_rays = None  # a cache hit does not trace
+    assert abs(cached.piercings_matrix - traced_matrix).max() == 0
+    np.testing.assert_array_equal(cached.struct_projected.vertices, traced.struct_projected.vertices)
+    np.testing.assert_array_equal(cached.struct_projected.faces, traced.struct_projected.faces)
+
+
+def test_cache_removes_stale_tmp(tmp_path):
+    cache = PiercingsCache(str(tmp_path), tmp_max_age=60)
+    stale = tmp_path / '.stale.tmp'
+    fresh = tmp_path / '.fresh.tmp'
+    stale.write_bytes(b'0')
+    fresh.write_bytes(b'0')
+    old = time.time() - 120
+    os.utime(stale, (old, old))
+    cache.evict()
+    assert not stale.exists()
+    assert fresh.exists()
@@ -0,0 +1,73 @@
+import os
+
+import numpy as np
+
+from xmcd_projection import Mesh, VoxelGrid, get_ovf_points_values, load_mesh_magnetisation, load_ovf
+
+EXAMPLES = os.path.join(os.path.dirname(__file__), '..', 'examples')
+MUMAX_MESH = os.path.join(EXAMPLES, 'mumax_mesh.vtu')
+MUMAX_MAG = os.path.join(EXAMPLES, 'mumax_mag.csv')
+
+
+def write_ovf(file_path, values, origin, step):
+    """Writes the (nx,ny,nz,3) cell values to the OVF 2.0 file with the 4 byte binary data, as mumax does.
+    """
+    header = ['OOMMF OVF 2.0', 'Segment count: 1', 'Begin: Segment', 'Begin: Header',
+              'meshtype: rectangular', 'meshunit: m']
+    for k, axis in enumerate('xyz'):
+        header += ['{}min: {!r}'.format(axis, float(origin[k])),
+                   '{}max: {!r}'.format(axis, float(origin[k] + values.shape[k] * step[k])),
+                   '{}nodes: {}'.format(axis, values.shape[k]),
+                   '{}stepsize: {!r}'.format(axis, float(step[k]))]
+    header += ['valuedim: 3', 'End: Header', 'Begin: Data Binary 4']
+    with open(file_path, 'wb') as f:
+        f.write(''.join('# {}\n'.format(line) for line in header).encode())
+        f.write(np.array([1234567.0], dtype='<f4').tobytes())
+        # the x index changes the fastest in the file
+        f.write(values.transpose(2, 1, 0, 3).astype('<f4').tobytes())
+        f.write(b'\n# End: Data Binary 4\n# End: Segment\n')
+
+
+def get_mumax_ovf(tmp_path):
+    """Writes the magnetisation of the mumax example to the .ovf file, with the points of the .csv file at the centres of the cells.
+    """
+    magnetisation, points = load_mesh_magnetisation(MUMAX_MAG)
+    step = np.full(3, 1e-8)
+    origin = points.min(axis=0) - step / 2 - step
+    shape = np.round(np.ptp(points, axis=0) / step).astype(np.int64) + 3
+    values = np.zeros(tuple(shape) + (3,))
+    values[tuple(np.floor((points - origin) / step).astype(np.int64).T)] = magnetisation
+    file_path = str(tmp_path / 'm000000.ovf')
+    write_ovf(file_path, values, origin, step)
+    return file_path, values, magnetisation, points
+
+
+def test_load_ovf(tmp_path):
+    file_path, values, _, _ = get_mumax_ovf(tmp_path)
+    loaded, header = load_ovf(file_path)
+    assert loaded.shape == values.shape
+    assert header['xnodes'] == values.shape[0]
+    np.testing.assert_allclose(loaded, values, atol=1e-6)
+
+
+def test_ovf_points_values_mumax_mesh(tmp_path):
+    file_path, _, magnetisation, points = get_mumax_ovf(tmp_path)
+    values, header = load_ovf(file_path)
+    mesh = Mesh.from_file(MUMAX_MESH, scale=1e9)
+    expected = magnetisation[mesh.get_shuffle_indx(points * 1e9)]
+    points_values = get_ovf_points_values(values, header, mesh.points, scale=1e9)
+    np.testing.assert_allclose(points_values, expected, atol=1e-6)
+    np.testing.assert_allclose(get_ovf_points_values(values, header, mesh.points, scale=1e9, centred=True),
+                               points_values)
+
+
+def test_ovf_grid_lines_up_with_vtu_grid(tmp_path):
+    file_path, _, _, _ = get_mumax_ovf(tmp_path)
+    ovf_grid = VoxelGrid.from_ovf(file_path, scale=1e9)
+    vtu_grid = VoxelGrid.from_file(MUMAX_MESH, scale=1e9)
+    np.testing.assert_allclose(vtu_grid.spacing, ovf_grid.spacing)
+    shift = (vtu_grid.origin - ovf_grid.origin) / ovf_grid.spacing
+    np.testing.assert_allclose(shift, np.round(shift), atol=1e-6)
+    start = np.round(shift).astype(np.int64)
+    window = tuple(slice(s, s + n) for s, n in zip(start, vtu_grid.shape))
+    np.testing.assert_array_equal(ovf_grid.mask[window], vtu_grid.mask)
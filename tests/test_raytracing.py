@@ -0,0 +1,30 @@
+import os
+
+import numpy as np
+import pytest
+
+from xmcd_projection import Mesh, RayTracing, get_projection_vector, load_mesh_magnetisation
+
+EXAMPLES = os.path.join(os.path.dirname(__file__), '..', 'examples')
+
+
+@pytest.fixture(scope='module')
+def mesh():
+    return Mesh.from_file(os.path.join(EXAMPLES, 'example_mesh.msh'))
+
+
+@pytest.fixture(scope='module')
+def magnetisation(mesh):
+    magnetisation, mag_points = load_mesh_magnetisation(
+        os.path.join(EXAMPLES, 'mag_data.csv'))
+    return magnetisation[mesh.get_shuffle_indx(mag_points), :]
+
+
+def test_methods_give_the_same_xmcd(mesh, magnetisation):
+    p = get_projection_vector(90, 16)
+    xmcd = {method: RayTracing(mesh, p, method=method).get_xmcd(magnetisation)
+            for method in ('batched', 'walk', 'loop')}
+    scale = np.abs(xmcd['loop']).max()
+    np.testing.assert_allclose(xmcd['batched'], xmcd['loop'], atol=1e-9 * scale)
+    np.testing.assert_allclose(xmcd['walk'], xmcd['loop'], atol=1e-9 * scale)
+
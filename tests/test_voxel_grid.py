@@ -0,0 +1,36 @@
+import os
+
+import numpy as np
+
+from xmcd_projection import VoxelGrid, VoxelRayTracing, get_projection_vector, load_mesh_magnetisation
+
+EXAMPLES = os.path.join(os.path.dirname(__file__), '..', 'examples')
+
+
+def test_dda_lengths_in_full_grid():
+    grid = VoxelGrid([0, 0, 0], [1, 2, 3], [5, 4, 3])
+    raytr = VoxelRayTracing(grid, [0.1, 0.2, 1])
+    # rays crossing the top and the bottom of the grid go through its whole height
+    centres = raytr.struct_projected.triangles_center
+    lengths = np.asarray(raytr.piercings_matrix.sum(axis=1)).ravel()
+    full = lengths > 9 / abs(raytr.p[2]) - 1e-9
+    assert np.any(full)
+    np.testing.assert_allclose(lengths[full], 9 / abs(raytr.p[2]))
+    assert np.all(lengths <= 9 / abs(raytr.p[2]) + 1e-9)
+    assert raytr.piercings_matrix.shape == (centres.shape[0], grid.n_cells)
+
+
+def test_mumax_grid_from_file():
+    grid = VoxelGrid.from_file(os.path.join(EXAMPLES, 'mumax_mesh.vtu'), scale=1e9)
+    magnetisation, mag_points = load_mesh_magnetisation(
+        os.path.join(EXAMPLES, 'mumax_mag.csv'), scale=1e9)
+    shuffle_indx = grid.get_shuffle_indx(mag_points)
+    np.testing.assert_allclose(mag_points[shuffle_indx], grid.points, atol=1e-6)
+    # the points are at the centres of the filled cells
+    np.testing.assert_allclose(grid.origin + (grid.point_cell_index + 0.5) * grid.spacing, grid.points, atol=1e-6)
+    assert grid.n_cells == grid.points.shape[0]
+    magnetisation = magnetisation[shuffle_indx, :]
+    raytr = VoxelRayTracing(grid, get_projection_vector(90, 16))
+    cell_magnetisation = np.zeros(tuple(grid.shape) + (3,))
+    cell_magnetisation[tuple(grid.point_cell_index.T)] = magnetisation
+    np.testing.assert_allclose(raytr.get_xmcd(magnetisation), raytr.get_xmcd_cells(cell_magnetisation))
@@ -1,9 +1,17 @@
 from .data_loading import *
 from .color import *
-from .mesh_visualisation import MeshVisualizer
+try:
+    from .mesh_visualisation import MeshVisualizer
+except ImportError:
+    # the visualizer needs Qt and OpenGL, MeshRasterizer renders without them
+    pass
 from .mesh import Mesh
 from .projection import get_projection_vector
-from .raytracing import RayTracing
+from .raytracing import RayTracing, sweep_directions
+from .cache import PiercingsCache, MeshCache
+from .preview import MeshPreview
+from .voxel_grid import VoxelGrid, VoxelRayTracing
+from .rasterizer import MeshRasterizer
 from .image import *
 
 
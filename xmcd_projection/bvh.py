@@ -0,0 +1,339 @@
+import json
+import os
+
+import numpy as np
+from numba import njit
+
+
+class BVH():
+    """Bounding volume hierarchy of triangles stored in flat numpy arrays.
+    The triangles are sorted along a Morton curve of their centres and grouped into leaves of leaf_size triangles.
+    The leaves are the bottom level of a complete binary tree stored in heap order (children of node i are 2i+1 and 2i+2),
+    so the tree needs no child pointers and is built level by level with vectorized numpy operations.
+    All the arrays can be saved to disk and memory mapped, and the ray queries run in compiled numba kernels.
+
+        Args:
+            points ((n,3) array): Points of the triangles.
+            faces ((m,3) array): Indices of the triangle points.
+            leaf_size (int, optional): Number of triangles in a leaf. Defaults to 4.
+            bounds_dtype (numpy.dtype, optional): Type of the node bounds. np.float32 halves their memory,
+                the bounds are then rounded outward so that they still contain the triangles. Defaults to np.float64.
+    """
+
+    def __init__(self, points, faces, leaf_size=4, bounds_dtype=np.float64):
+        self.points = np.asanyarray(points)
+        self.faces = np.asanyarray(faces)
+        self.leaf_size = int(leaf_size)
+        self.node_lo, self.node_hi, self.order = self.build(
+            self.points, self.faces, self.leaf_size, bounds_dtype=bounds_dtype)
+
+    @classmethod
+    def from_triangles(cls, triangles, leaf_size=4):
+        """Creates the BVH from the array of triangles.
+
+        Args:
+            triangles ((m,3,3) array): Triangles
+            leaf_size (int, optional): Number of triangles in a leaf. Defaults to 4.
+
+        Returns:
+            BVH
+        """
+        triangles = np.asanyarray(triangles)
+        faces = np.arange(3 * triangles.shape[0]).reshape(-1, 3)
+        return cls(triangles.reshape(-1, 3), faces, leaf_size=leaf_size)
+
+    @classmethod
+    def from_arrays(cls, points, faces, node_lo, node_hi, order, leaf_size):
+        """Creates the BVH from the already built arrays.
+        """
+        bvh = cls.__new__(cls)
+        bvh.points = points
+        bvh.faces = faces
+        bvh.node_lo = node_lo
+        bvh.node_hi = node_hi
+        bvh.order = order
+        bvh.leaf_size = int(leaf_size)
+        return bvh
+
+    @staticmethod
+    def build(points, faces, leaf_size, bounds_dtype=np.float64, chunk_size=2**20):
+        """Builds the tree. The triangles are processed in chunks, so only the Morton codes and the order are held for all of them.
+
+        Returns:
+            tuple: lower bounds of the nodes ((k,3) array), upper bounds of the nodes ((k,3) array), order of the triangles in the leaves ((m,) array)
+        """
+        n = faces.shape[0]
+        if points.shape[0] > 0:
+            lo = points.min(axis=0).astype(np.float64)
+            extent = points.max(axis=0) - lo
+        else:
+            lo, extent = np.zeros(3), np.ones(3)
+        codes = np.empty(n, dtype=np.int64)
+        for start in range(0, n, chunk_size):
+            triangles = points[faces[start:start + chunk_size]]
+            codes[start:start + chunk_size] = morton_codes(
+                (triangles.min(axis=1) + triangles.max(axis=1)) / 2, lo=lo, extent=extent)
+        order = np.argsort(codes, kind='stable')
+        del codes
+        if n < 2**31:
+            order = order.astype(np.int32)
+
+        n_leaves = max(-(-n // leaf_size), 1)
+        n_leaves_padded = 1 << int(np.ceil(np.log2(n_leaves)))
+        n_nodes = 2 * n_leaves_padded - 1
+        first_leaf = n_leaves_padded - 1
+        # empty nodes have inverted bounds and are skipped by the ray queries
+        node_lo = np.full((n_nodes, 3), np.inf, dtype=bounds_dtype)
+        node_hi = np.full((n_nodes, 3), -np.inf, dtype=bounds_dtype)
+        # bounds of the leaves from the sorted triangles, chunk by chunk
+        chunk_size = max(chunk_size // leaf_size, 1) * leaf_size
+        for start in range(0, n, chunk_size):
+            triangles = points[faces[order[start:start + chunk_size]]]
+            leaf_starts = np.arange(0, triangles.shape[0], leaf_size)
+            leaf = first_leaf + start // leaf_size
+            node_lo[leaf:leaf + leaf_starts.size] = round_bounds(np.minimum.reduceat(
+                triangles.min(axis=1), leaf_starts, axis=0), bounds_dtype, -np.inf)
+            node_hi[leaf:leaf + leaf_starts.size] = round_bounds(np.maximum.reduceat(
+                triangles.max(axis=1), leaf_starts, axis=0), bounds_dtype, np.inf)
+        # go up the tree level by level
+        level_start = n_leaves_padded - 1
+        while level_start > 0:
+            parent_start = (level_start - 1) // 2
+            children = np.arange(level_start, 2 * level_start + 1)
+            node_lo[parent_start:level_start] = np.minimum(
+                node_lo[children[0::2]], node_lo[children[1::2]])
+            node_hi[parent_start:level_start] = np.maximum(
+                node_hi[children[0::2]], node_hi[children[1::2]])
+            level_start = parent_start
+        return node_lo, node_hi, order
+
+    def intersect(self, ray_origins, ray_direction, chunk_size=4096):
+        """Finds all the intersections of the lines through the ray origins along the ray direction with the triangles.
+        Like the rest of the raytracing, the whole line is considered, on both sides of the origin.
+
+        Args:
+            ray_origins ((n,3) array): Origins of the rays.
+            ray_direction ((3,) array): Direction of all the rays.
+            chunk_size (int, optional): Number of rays traced in one pass. Defaults to 4096.
+
+        Returns:
+            tuple: index_ray ((h,) array), index_triangle ((h,) array), distance along the ray ((h,) array) of the intersections sorted by ray.
+        """
+        ray_origins = np.ascontiguousarray(ray_origins, dtype=np.float64)
+        ray_direction = np.asanyarray(ray_direction, dtype=np.float64)
+        with np.errstate(divide='ignore'):
+            inv_direction = 1 / ray_direction
+        results = []
+        for start in range(0, ray_origins.shape[0], chunk_size):
+            chunk = ray_origins[start:start + chunk_size]
+            counts = _bvh_count(chunk, ray_direction, inv_direction, self.points, self.faces, self.node_lo, self.node_hi,
+                                self.order, self.leaf_size)
+            index_ray, index_tri, t = _bvh_fill(chunk, ray_direction, inv_direction, self.points, self.faces, self.node_lo, self.node_hi,
+                                                self.order, self.leaf_size, counts)
+            results.append((index_ray + start, index_tri, t))
+        if len(results) == 0:
+            return (np.array([], dtype=np.int64),
+                    np.array([], dtype=np.int64),
+                    np.array([], dtype=np.float64))
+        return tuple(np.concatenate(arrs) for arrs in zip(*results))
+
+    def save(self, dir_path):
+        """Saves the arrays of the BVH as .npy files in the directory so that they can be memory mapped by load.
+
+        Args:
+            dir_path (str): Directory path. Created if it does not exist.
+        """
+        os.makedirs(dir_path, exist_ok=True)
+        for name in ('points', 'faces', 'node_lo', 'node_hi', 'order'):
+            np.save(os.path.join(dir_path, name + '.npy'), getattr(self, name))
+        with open(os.path.join(dir_path, 'bvh.json'), 'w') as f:
+            json.dump({'leaf_size': self.leaf_size}, f)
+
+    @classmethod
+    def load(cls, dir_path, mmap_mode='r'):
+        """Loads the BVH saved by save.
+
+        Args:
+            dir_path (str): Directory path.
+            mmap_mode (str, optional): Memory mapping mode passed to numpy.load. Defaults to 'r', so the arrays are shared between the processes loading them.
+
+        Returns:
+            BVH
+        """
+        arrays = {name: np.load(os.path.join(dir_path, name + '.npy'), mmap_mode=mmap_mode)
+                  for name in ('points', 'faces', 'node_lo', 'node_hi', 'order')}
+        with open(os.path.join(dir_path, 'bvh.json'), 'r') as f:
+            meta = json.load(f)
+        return cls.from_arrays(leaf_size=meta['leaf_size'], **arrays)
+
+
+def round_bounds(bounds, dtype, direction):
+    """Converts the bounds to the dtype, rounding them towards the direction so that the boxes are not shrunk.
+
+    Args:
+        bounds ((n,3) array)
+        dtype (numpy.dtype)
+        direction (float): -np.inf for the lower bounds, np.inf for the upper bounds.
+
+    Returns:
+        (n,3) array
+    """
+    rounded = bounds.astype(dtype)
+    if np.dtype(dtype).itemsize < bounds.dtype.itemsize:
+        moved = rounded > bounds if direction < 0 else rounded < bounds
+        rounded[moved] = np.nextafter(
+            rounded[moved], np.array(direction, dtype=dtype))
+    return rounded
+
+
+def morton_codes(pts, lo=None, extent=None):
+    """Gets the 30 bit Morton codes of the points in their bounding box.
+
+    Args:
+        pts ((n,3) array): Points
+        lo ((3,) array, optional): Lower corner of the box. Defaults to the bounding box of the points.
+        extent ((3,) array, optional): Size of the box. Defaults to the bounding box of the points.
+
+    Returns:
+        (n,) array: Morton codes
+    """
+    if pts.shape[0] == 0:
+        return np.zeros(0, dtype=np.int64)
+    if lo is None:
+        lo = pts.min(axis=0)
+        extent = pts.max(axis=0) - lo
+    extent = np.array(extent, dtype=np.float64)
+    extent[extent == 0] = 1
+    q = np.clip(((pts - lo) / extent * 1023), 0, 1023).astype(np.int64)
+
+    def spread_bits(x):
+        x = (x | (x << 16)) & 0x030000FF
+        x = (x | (x << 8)) & 0x0300F00F
+        x = (x | (x << 4)) & 0x030C30C3
+        x = (x | (x << 2)) & 0x09249249
+        return x
+    return (spread_bits(q[:, 0]) << 2) | (spread_bits(q[:, 1]) << 1) | spread_bits(q[:, 2])
+
+
+@njit(cache=True, nogil=True)
+def _line_box(origin, inv_dir, lo, hi):
+    """Checks if the line intersects the axis aligned box. The box is checked with a relative tolerance,
+    so that the lines along the faces of the box (e.g. through the edges of axis aligned triangles) are not culled by rounding.
+    """
+    eps = 1e-9
+    # empty nodes of the padded tree
+    if lo[0] > hi[0]:
+        return False
+    t_min = -np.inf
+    t_max = np.inf
+    for k in range(3):
+        if np.isinf(inv_dir[k]):
+            pad = eps * max(abs(lo[k]), abs(hi[k]), hi[k] - lo[k])
+            if origin[k] < lo[k] - pad or origin[k] > hi[k] + pad:
+                return False
+        else:
+            t1 = (lo[k] - origin[k]) * inv_dir[k]
+            t2 = (hi[k] - origin[k]) * inv_dir[k]
+            if t1 > t2:
+                t1, t2 = t2, t1
+            t_min = max(t_min, t1)
+            t_max = min(t_max, t2)
+    return t_min <= t_max + eps * max(abs(t_min), abs(t_max))
+
+
+@njit(cache=True, nogil=True)
+def _line_triangle(origin, direction, points, face):
+    """Moller-Trumbore intersection of the line with the triangle. Returns the distance along the line or nan if there is no intersection.
+    """
+    eps = 1e-12
+    ax, ay, az = points[face[0], 0], points[face[0], 1], points[face[0], 2]
+    e1x, e1y, e1z = points[face[1], 0] - ax, points[face[1], 1] - ay, points[face[1], 2] - az
+    e2x, e2y, e2z = points[face[2], 0] - ax, points[face[2], 1] - ay, points[face[2], 2] - az
+    dx, dy, dz = direction[0], direction[1], direction[2]
+    hx, hy, hz = dy * e2z - dz * e2y, dz * e2x - dx * e2z, dx * e2y - dy * e2x
+    det = e1x * hx + e1y * hy + e1z * hz
+    # triangles parallel to the line can not be pierced in their interior
+    if abs(det) <= eps * np.sqrt((e1x * e1x + e1y * e1y + e1z * e1z) * (e2x * e2x + e2y * e2y + e2z * e2z)):
+        return np.nan
+    sx, sy, sz = origin[0] - ax, origin[1] - ay, origin[2] - az
+    u = (sx * hx + sy * hy + sz * hz) / det
+    if u < -eps or u > 1 + eps:
+        return np.nan
+    qx, qy, qz = sy * e1z - sz * e1y, sz * e1x - sx * e1z, sx * e1y - sy * e1x
+    v = (dx * qx + dy * qy + dz * qz) / det
+    if v < -eps or u + v > 1 + eps:
+        return np.nan
+    return (e2x * qx + e2y * qy + e2z * qz) / det
+
+
+@njit(cache=True, nogil=True)
+def _bvh_count(ray_origins, direction, inv_dir, points, faces, node_lo, node_hi, order, leaf_size):
+    """Counts the triangle hits of each ray.
+    """
+    n_rays = ray_origins.shape[0]
+    counts = np.zeros(n_rays, dtype=np.int64)
+    n_nodes = node_lo.shape[0]
+    first_leaf = n_nodes // 2
+    n_tri = order.shape[0]
+    stack = np.empty(64, dtype=np.int64)
+    for r in range(n_rays):
+        orig = ray_origins[r]
+        n_stack = 1
+        stack[0] = 0
+        while n_stack > 0:
+            n_stack -= 1
+            node = stack[n_stack]
+            if not _line_box(orig, inv_dir, node_lo[node], node_hi[node]):
+                continue
+            if node >= first_leaf:
+                start = (node - first_leaf) * leaf_size
+                for i in range(start, min(start + leaf_size, n_tri)):
+                    t = _line_triangle(orig, direction,
+                                       points, faces[order[i]])
+                    if not np.isnan(t):
+                        counts[r] += 1
+            else:
+                stack[n_stack] = 2 * node + 1
+                stack[n_stack + 1] = 2 * node + 2
+                n_stack += 2
+    return counts
+
+
+@njit(cache=True, nogil=True)
+def _bvh_fill(ray_origins, direction, inv_dir, points, faces, node_lo, node_hi, order, leaf_size, counts):
+    """Records the triangle hits of each ray.
+    """
+    n_rays = ray_origins.shape[0]
+    n_hits = np.sum(counts)
+    index_ray = np.empty(n_hits, dtype=np.int64)
+    index_tri = np.empty(n_hits, dtype=np.int64)
+    t_hit = np.empty(n_hits, dtype=np.float64)
+    n_nodes = node_lo.shape[0]
+    first_leaf = n_nodes // 2
+    n_tri = order.shape[0]
+    stack = np.empty(64, dtype=np.int64)
+    j = 0
+    for r in range(n_rays):
+        orig = ray_origins[r]
+        n_stack = 1
+        stack[0] = 0
+        while n_stack > 0:
+            n_stack -= 1
+            node = stack[n_stack]
+            if not _line_box(orig, inv_dir, node_lo[node], node_hi[node]):
+                continue
+            if node >= first_leaf:
+                start = (node - first_leaf) * leaf_size
+                for i in range(start, min(start + leaf_size, n_tri)):
+                    t = _line_triangle(orig, direction,
+                                       points, faces[order[i]])
+                    if not np.isnan(t):
+                        index_ray[j] = r
+                        index_tri[j] = order[i]
+                        t_hit[j] = t
+                        j += 1
+            else:
+                stack[n_stack] = 2 * node + 1
+                stack[n_stack + 1] = 2 * node + 2
+                n_stack += 2
+    return index_ray, index_tri, t_hit
@@ -0,0 +1,265 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+import trimesh
+from scipy import sparse
+
+from .bvh import BVH
+
+# bump when the stored data changes so that old entries are not used
+CACHE_VERSION = 2
+
+
+class PiercingsCache():
+    """On-disk cache of the projected structure and the piercings of RayTracing.
+    Each entry is a single uncompressed .npz file named by the hash of the mesh and the beam geometry.
+    Entries are written to a temporary file and then atomically renamed, so several processes can safely write to the same directory.
+    When the total size exceeds max_size, the least recently used entries are removed.
+    The temporary files left by the writers that crashed before the rename are removed once they are older than tmp_max_age.
+
+        Args:
+            cache_dir (str): Directory of the cache. Created if it does not exist.
+            max_size (int, optional): Maximum total size of the cache in bytes. Defaults to 1 GB.
+            tmp_max_age (float, optional): Age in seconds after which the temporary files are removed. Defaults to 1 hour.
+    """
+
+    def __init__(self, cache_dir, max_size=2**30, tmp_max_age=3600):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.tmp_max_age = tmp_max_age
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    @staticmethod
+    def get_key(mesh, p, n, x0, tol, pose=None):
+        """Gets the key of the cache entry from the mesh content, its pose and the beam geometry.
+
+        Args:
+            mesh (Mesh)
+            p ((3,) array): Beam direction vector.
+            n ((3,) array): Normal to the projection plane.
+            x0 ((3,) array): Point on the projection plane.
+            tol (float): Tolerance for numerical errors.
+            pose (Pose, optional): Pose of the mesh. Defaults to the current pose of the mesh.
+
+        Returns:
+            str: Hex digest of the key.
+        """
+        h = hashlib.sha1()
+        h.update(str(CACHE_VERSION).encode())
+        h.update(np.ascontiguousarray(mesh.points, dtype=np.float64).tobytes())
+        h.update(np.ascontiguousarray(mesh.tetra, dtype=np.int64).tobytes())
+        if pose is None:
+            pose = mesh
+        h.update(np.ascontiguousarray(pose.rotation, dtype=np.float64).tobytes())
+        h.update(np.ascontiguousarray(pose.translation, dtype=np.float64).tobytes())
+        for v in (p, n, x0, [tol]):
+            h.update(np.ascontiguousarray(v, dtype=np.float64).tobytes())
+        return h.hexdigest()
+
+    def get_path(self, key):
+        return os.path.join(self.cache_dir, key + '.npz')
+
+    def load(self, key):
+        """Loads the cache entry.
+
+        Args:
+            key (str): Key of the entry.
+
+        Returns:
+            tuple: struct_projected (trimesh.Trimesh), piercings_matrix (scipy.sparse.csr_matrix) or None if there is no entry.
+        """
+        path = self.get_path(key)
+        try:
+            with np.load(path) as data:
+                struct_projected = trimesh.Trimesh(vertices=data['vertices'],
+                                                   faces=data['faces'], process=False)
+                piercings_matrix = sparse.csr_matrix(
+                    (data['data'], data['indices'], data['indptr']), shape=tuple(data['shape']))
+        except (FileNotFoundError, OSError, KeyError, ValueError):
+            return None
+        # mark as recently used
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return struct_projected, piercings_matrix
+
+    def save(self, key, struct_projected, piercings_matrix):
+        """Saves the cache entry and evicts the least recently used entries if the cache is too big.
+
+        Args:
+            key (str): Key of the entry.
+            struct_projected (trimesh.Trimesh): Projected structure.
+            piercings_matrix (scipy.sparse.csr_matrix): Piercings matrix.
+        """
+        fd, tmp_path = tempfile.mkstemp(
+            dir=self.cache_dir, prefix='.' + key, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, vertices=np.asarray(struct_projected.vertices), faces=np.asarray(struct_projected.faces),
+                         data=piercings_matrix.data, indices=piercings_matrix.indices,
+                         indptr=piercings_matrix.indptr, shape=np.array(piercings_matrix.shape))
+            os.replace(tmp_path, self.get_path(key))
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self.evict()
+
+    def remove_stale_tmp(self):
+        """Removes the temporary files older than tmp_max_age, left by the writers that crashed before renaming them.
+        The younger files may still be written, so they are kept.
+        """
+        now = time.time()
+        for entry in os.scandir(self.cache_dir):
+            if not entry.name.endswith('.tmp'):
+                continue
+            try:
+                if now - entry.stat().st_mtime > self.tmp_max_age:
+                    os.remove(entry.path)
+            except FileNotFoundError:
+                # renamed or removed by another process
+                pass
+
+    def evict(self):
+        """Removes the least recently used entries until the cache is smaller than max_size, and the stale temporary files.
+        """
+        self.remove_stale_tmp()
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if not entry.name.endswith('.npz'):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                # already removed by another process
+                pass
+            total -= size
+
+    def clear(self):
+        """Removes all the entries of the cache and the stale temporary files.
+        """
+        self.remove_stale_tmp()
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith('.npz'):
+                try:
+                    os.remove(entry.path)
+                except FileNotFoundError:
+                    pass
+
+
+class MeshCache():
+    """Sidecar binary store of the mesh read from a .msh or .vtu file, so that the file is parsed only once.
+    Each entry is a directory of .npy files with the points, the tetrahedra and their parts, the derived neighbours and edge faces and the bounding volume hierarchy.
+    The entries are loaded with memory mapping, so large meshes open quickly and the processes loading the same entry share the pages.
+    The key contains the size and modification time of the source file, so the entries of a changed file are not used.
+
+        Args:
+            file_path (str): Path of the mesh file.
+            cache_dir (str, optional): Directory of the store. Defaults to file_path + '.cache'.
+    """
+
+    def __init__(self, file_path, cache_dir=None):
+        self.file_path = file_path
+        self.cache_dir = file_path + '.cache' if cache_dir is None else cache_dir
+
+    def get_source_stat(self):
+        stat = os.stat(self.file_path)
+        return {'path': os.path.abspath(self.file_path), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+    def get_key(self, **options):
+        """Gets the key of the entry from the source file and the loading options.
+
+        Args:
+            **options: Options of Mesh.from_file changing the stored arrays. Must be json serializable.
+
+        Returns:
+            str: Hex digest of the key.
+        """
+        meta = {'version': CACHE_VERSION,
+                'source': self.get_source_stat(), 'options': options}
+        return hashlib.sha1(json.dumps(meta, sort_keys=True).encode()).hexdigest()
+
+    def get_path(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def load(self, key, mmap_mode='c'):
+        """Loads the entry.
+
+        Args:
+            key (str): Key of the entry.
+            mmap_mode (str, optional): Memory mapping mode passed to numpy.load. The default copy-on-write mode shares the pages
+                between processes and still allows changing the arrays in memory. Defaults to 'c'.
+
+        Returns:
+            dict: points, tetra, tetra_neighbours, edge_faces, part_offsets (arrays), parts (list) and bvh (BVH), or None if there is no entry.
+        """
+        path = self.get_path(key)
+        try:
+            bvh = BVH.load(os.path.join(path, 'bvh'), mmap_mode=mmap_mode)
+            arrays = {name: np.load(os.path.join(path, name + '.npy'), mmap_mode=mmap_mode)
+                      for name in ('tetra', 'tetra_neighbours', 'edge_faces', 'part_offsets')}
+            with open(os.path.join(path, 'source.json'), 'r') as f:
+                arrays['parts'] = json.load(f)['parts']
+        except (FileNotFoundError, OSError, KeyError, ValueError):
+            return None
+        # the BVH already stores the points and the faces of the mesh
+        return dict(points=bvh.points, bvh=bvh, **arrays)
+
+    def save(self, key, mesh):
+        """Saves the mesh to the entry and removes the entries made from the older versions of the source file.
+        The neighbours, the edge faces and the bounding volume hierarchy of the mesh are computed if they were not yet.
+
+        Args:
+            key (str): Key of the entry.
+            mesh (Mesh)
+        """
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_path = tempfile.mkdtemp(dir=self.cache_dir, prefix='.' + key)
+        try:
+            mesh.bvh.save(os.path.join(tmp_path, 'bvh'))
+            for name in ('tetra', 'tetra_neighbours', 'edge_faces', 'part_offsets'):
+                np.save(os.path.join(tmp_path, name + '.npy'),
+                        getattr(mesh, name))
+            with open(os.path.join(tmp_path, 'source.json'), 'w') as f:
+                json.dump(dict(self.get_source_stat(),
+                               parts=mesh.part_ids), f)
+            os.rename(tmp_path, self.get_path(key))
+        except OSError:
+            # another process has already saved the same entry
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            if not os.path.isdir(self.get_path(key)):
+                raise
+        self.remove_outdated()
+
+    def remove_outdated(self):
+        """Removes the entries made from the source file before it was changed.
+        The entries of the other files sharing the cache directory are kept.
+        """
+        source = self.get_source_stat()
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.startswith('.') or not entry.is_dir():
+                continue
+            try:
+                with open(os.path.join(entry.path, 'source.json'), 'r') as f:
+                    stored = json.load(f)
+            except (FileNotFoundError, ValueError):
+                continue
+            outdated = stored.get('path') == source['path'] and (
+                stored.get('size') != source['size'] or stored.get('mtime_ns') != source['mtime_ns'])
+            if outdated:
+                shutil.rmtree(entry.path, ignore_errors=True)
@@ -1,12 +1,72 @@
+import hashlib
+from functools import lru_cache
+
 from skimage.color.colorconv import rgb2gray, rgba2rgb
 import matplotlib.cm as cm
 from matplotlib import colors
 import numpy as np
+from scipy import sparse
 
 # TODO: check the caption
 
 
-def get_xmcd_color(xmcd, vmin=None, vmax=None):
+@lru_cache(maxsize=None)
+def _get_colormap_lut(cmap_name, n_colors, dtype):
+    cmap = getattr(cm, cmap_name)
+    if cmap.N != n_colors:
+        cmap = cmap.resampled(n_colors) if hasattr(
+            cmap, 'resampled') else cmap._resample(n_colors)
+    lut = cmap(np.arange(n_colors))
+    if dtype == np.uint8:
+        # same conversion as matplotlib with bytes=True
+        lut = (lut * 255).astype(np.uint8)
+    lut = lut.astype(dtype)
+    lut.flags.writeable = False
+    return lut
+
+
+def get_colormap_lut(cmap_name, n_colors=256, dtype=np.float64):
+    """Gets the lookup table of the colormap. The tables are cached, so they are computed only once for each colormap.
+
+    Args:
+        cmap_name (str): Matplotlib colormap specifier.
+        n_colors (int, optional): Number of colours in the table. Defaults to 256.
+        dtype (numpy.dtype, optional): Type of the colours. Floats are in [0,1] and np.uint8 in [0,255]. Defaults to np.float64.
+
+    Returns:
+        (n_colors,4) array: Read-only RGBA colours.
+    """
+    return _get_colormap_lut(cmap_name, n_colors, np.dtype(dtype))
+
+
+def values_to_color(values, vmin, vmax, cmap_name, n_colors=256, out=None):
+    """Maps the values to the colours of the colormap by quantizing them into the lookup table (see get_colormap_lut).
+    The values outside of [vmin, vmax] get the colours of the ends of the colormap.
+
+    Args:
+        values ((n,) array): Values to be mapped.
+        vmin (float): Value mapped to the first colour.
+        vmax (float): Value mapped to the last colour.
+        cmap_name (str): Matplotlib colormap specifier.
+        n_colors (int, optional): Number of colours in the lookup table. Defaults to 256.
+        out ((n,4) array, optional): Array into which the colours are written. Its type (e.g. np.uint8 or np.float32) sets the type of the colours.
+            Defaults to None, which returns new np.float64 colours.
+
+    Returns:
+        (n,4) array: Colours of the values.
+    """
+    lut = get_colormap_lut(
+        cmap_name, n_colors, np.float64 if out is None else out.dtype)
+    values = np.asanyarray(values)
+    if vmax > vmin:
+        idx = (values - vmin) * (n_colors / (vmax - vmin))
+    else:
+        idx = np.zeros(values.shape)
+    idx = np.clip(idx, 0, n_colors - 1, out=idx).astype(np.intp)
+    return np.take(lut, idx, axis=0, out=out)
+
+
+def get_xmcd_color(xmcd, vmin=None, vmax=None, out=None):
     """Gets the color of the xmcd vector in grayscale. 
     It scales the colours linearly to the range between vmin and vmax.
     If vmin(vmax) is None, use min (max) of xmcd.
@@ -15,6 +75,7 @@ def get_xmcd_color(xmcd, vmin=None, vmax=None):
         xmcd ((n,) array): xmcd values to be normalized
         vmin (int, optional): Min of normalization. Defaults to None.
         vmax (int, optional): Max of normalization. Defaults to None.
+        out ((n,4) array, optional): Array into which the colours are written, e.g. np.uint8 or np.float32 (see values_to_color). Defaults to None.
 
     Returns:
         tule: xmcd_color ((n, 4) array); background_color ((4,) array)
@@ -23,55 +84,66 @@ def get_xmcd_color(xmcd, vmin=None, vmax=None):
         vmin = xmcd.min()
     if vmax is None:
         vmax = xmcd.max()
-    # get the colormap
-    norm = colors.Normalize(vmin=vmin, vmax=vmax)
-    cmap = cm.binary
-    # get the mapping function for colors
-    cmap_fun = cm.ScalarMappable(norm=norm, cmap=cmap)
-    # convert xmcd to color
-    xmcd_color = cmap_fun.to_rgba(xmcd)
-    background_color = cmap_fun.to_rgba(0)
+    xmcd_color = values_to_color(xmcd, vmin, vmax, 'binary', out=out)
+    background_color = values_to_color(
+        np.zeros(1), vmin, vmax, 'binary', out=None if out is None else np.empty((1, 4), dtype=out.dtype))[0]
 
     return xmcd_color, background_color
 
 
-def get_struct_face_mag_color(struct, magnetisation, cmap_name='seismic'):
+def get_face_averaging_operator(struct):
+    """Gets the sparse matrix averaging the per-vertex values over the vertices of each face of the structure.
+    It is stored on the structure with the hash of its faces, so it is computed only once until the faces change.
+
+    Args:
+        struct (trimesh.Trimesh): STL file with n faces, m vertices
+
+    Returns:
+        (n, m) scipy.sparse.csr_matrix
+    """
+    faces = np.ascontiguousarray(struct.faces)
+    key = (hashlib.sha1(faces).hexdigest(), faces.shape[0], len(struct.vertices))
+    cached = getattr(struct, 'face_averaging_operator', None)
+    if cached is None or cached[0] != key:
+        n_faces = faces.shape[0]
+        operator = sparse.csr_matrix((np.full(3 * n_faces, 1 / 3), (np.repeat(np.arange(n_faces), 3), faces.ravel())),
+                                     shape=(n_faces, len(struct.vertices)))
+        cached = (key, operator)
+        struct.face_averaging_operator = cached
+    return cached[1]
+
+
+def get_struct_face_mag_color(struct, magnetisation, cmap_name='seismic', out=None):
     """Gets the colours of the structure faces based on the magnetisation using the given colormap.
 
     Args:
         struct (trimesh.Trimesh): STL file with n faces, m vertices
         magnetisation ((m,3) array): per vertex magnetisation
         cmap_name (str, optional): Matplotlib colormap specifier. Defaults to 'seismic'.
+        out ((n,4) array, optional): Array into which the colours are written, e.g. np.uint8 or np.float32 (see values_to_color). Defaults to None.
 
     Returns:
         (n,4) array: Colours of struct faces
     """
-    face_magnetisation = np.mean(
-        [magnetisation[struct.faces[:, i], :] for i in range(3)], axis=0)
+    face_magnetisation = get_face_averaging_operator(
+        struct) @ np.asanyarray(magnetisation)
     mag_colors = magnetisation_to_color(
-        face_magnetisation, cmap_name=cmap_name)
+        face_magnetisation, cmap_name=cmap_name, out=out)
     return mag_colors
 
 
-def magnetisation_to_color(magnetisation, cmap_name='seismic', direction=[0, 0, 1]):
+def magnetisation_to_color(magnetisation, cmap_name='seismic', direction=[0, 0, 1], out=None):
     """Assigns color to magnetisation component.
 
     Args:
         magnetisation ((n,3) array): Magnetisation values
         cmap_name (str, optional): Matplotlib colormap. Defaults to 'seismic'.
         direction (list, optional): Direction along which to project the magnetisation. Defaults to [0, 0, 1].
+        out ((n,4) array, optional): Array into which the colours are written, e.g. np.uint8 or np.float32 (see values_to_color). Defaults to None.
 
     Returns:
         (n,4) array: Colours corresponding to values of magnetisation along the projection direction.
     """
-    # get the colormap
-    norm = colors.Normalize(vmin=-1, vmax=1)
-    cmap = getattr(cm, cmap_name)
-    # get the mapping function for colors
-    cmap_fun = cm.ScalarMappable(norm=norm, cmap=cmap)
-    # convert xmcd to color
     direction = np.array(direction) / np.linalg.norm(direction)
-    mag_comp = magnetisation.dot(direction)
-    mag_color = cmap_fun.to_rgba(mag_comp)
-
-    return np.array(mag_color)
+    mag_comp = np.asanyarray(magnetisation).dot(direction)
+    return values_to_color(mag_comp, -1, 1, cmap_name, out=out)
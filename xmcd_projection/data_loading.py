@@ -1,33 +1,360 @@
+import glob
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 import pandas as pd
+from joblib import Parallel, delayed
 from pandas.core.base import DataError
 
+__all__ = ['DataError', 'MAGNETISATION_COLUMNS', 'POINTS_COLUMNS', 'get_magnetisation_columns', 'read_magnetisation_columns',
+           'load_mesh_magnetisation', 'get_file_list', 'iter_mesh_magnetisation', 'load_mesh_magnetisation_stack',
+           'read_ovf_header', 'load_ovf', 'iter_ovf', 'get_ovf_points_values']
+
+try:
+    import pyarrow.parquet as pq
+except ImportError:
+    pq = None
+# the pyarrow csv engine is in pandas from 1.4
+PANDAS_VERSION = tuple(int(v) for v in pd.__version__.split('.')[:2])
+CSV_ENGINE = 'pyarrow' if pq is not None and PANDAS_VERSION >= (1, 4) else 'c'
+
+
+# names of the magnetisation and the point columns in the order in which they are looked for
+MAGNETISATION_COLUMNS = [['m:0', 'm:1', 'm:2'],
+                         ['velocity_vectors:0', 'velocity_vectors:1', 'velocity_vectors:2']]
+POINTS_COLUMNS = [['Points:0', 'Points:1', 'Points:2'],
+                  ['Coordinates:0', 'Coordinates:1', 'Coordinates:2']]
+
 
-def load_mesh_magnetisation(file_path, scale=1):
-    """Gets the mesh magnetisation from a csv file containing columns for points (named "Points:<0-2>") and magnetisation (named "m:<0-2>").
+def get_magnetisation_columns(columns):
+    """Picks the magnetisation and the point columns from the column names of the file.
 
     Args:
-        file_path (str): Path to the file.
+        columns (list of str): Column names.
+
+    Returns:
+        tuple: magnetisation columns (list of str), points columns (list of str)
+    """
+    columns = set(columns)
+    selected = []
+    for candidates in (MAGNETISATION_COLUMNS, POINTS_COLUMNS):
+        for names in candidates:
+            if columns.issuperset(names):
+                selected.append(names)
+                break
+        else:
+            raise DataError("Unrecognized format!")
+    return tuple(selected)
+
+
+def read_magnetisation_columns(file_path, dtype=np.float64):
+    """Reads only the magnetisation and the point columns of the file. Csv files are read with the header sniffed first,
+    so that the other columns are skipped by the parser (using the pyarrow engine if it is installed).
+    Npy files should contain a structured array and npz and parquet files named arrays or columns with the same names as the csv columns.
+
+    Args:
+        file_path (str): Path to the .csv, .npy, .npz or .parquet file.
+        dtype (numpy.dtype, optional): Type of the values. Defaults to np.float64.
+
+    Returns:
+        tuple: magnetisation ((n,3) array), points ((n,3), array)
+    """
+    ext = os.path.splitext(file_path)[1].lower()
+    if ext == '.npy':
+        data = np.load(file_path, mmap_mode='r')
+        if data.dtype.names is None:
+            raise DataError("Unrecognized format!")
+        m_cols, p_cols = get_magnetisation_columns(data.dtype.names)
+        return tuple(np.stack([data[c] for c in cols], axis=1).astype(dtype, copy=False) for cols in (m_cols, p_cols))
+    if ext == '.npz':
+        with np.load(file_path) as data:
+            m_cols, p_cols = get_magnetisation_columns(data.files)
+            return tuple(np.stack([data[c] for c in cols], axis=1).astype(dtype, copy=False) for cols in (m_cols, p_cols))
+    if ext in ('.parquet', '.pq'):
+        if pq is not None:
+            columns = pq.read_schema(file_path).names
+        else:
+            columns = pd.read_parquet(file_path).columns
+        m_cols, p_cols = get_magnetisation_columns(columns)
+        data = pd.read_parquet(file_path, columns=m_cols + p_cols)
+    else:
+        m_cols, p_cols = get_magnetisation_columns(
+            pd.read_csv(file_path, nrows=0).columns)
+        usecols = m_cols + p_cols
+        data = pd.read_csv(file_path, usecols=usecols, dtype={c: dtype for c in usecols},
+                           engine=CSV_ENGINE)
+    return data.loc[:, m_cols].to_numpy(dtype=dtype), data.loc[:, p_cols].to_numpy(dtype=dtype)
+
+
+def load_mesh_magnetisation(file_path, scale=1, dtype=np.float64):
+    """Gets the mesh magnetisation from a file containing columns for points (named "Points:<0-2>") and magnetisation (named "m:<0-2>").
+    Only these columns are read (see read_magnetisation_columns).
+
+    Args:
+        file_path (str): Path to the .csv, .npy, .npz or .parquet file.
         scale (float, optional): Scalar by which to scale coordinates. Default is 1.
+        dtype (numpy.dtype, optional): Type of the values, e.g. np.float32 to halve the memory. Defaults to np.float64.
 
     Returns:
         tuple: magnetisation ((n,3) array), points ((n,3), array)
     """
-    data = pd.read_csv(file_path)
-    if 'm:0' in data:
-        magnetisation = data.loc[:, ['m:0', 'm:1', 'm:2']].to_numpy()
-    elif 'velocity_vectors:0' in data:
-        magnetisation = data.loc[:, [
-            'velocity_vectors:0', 'velocity_vectors:1', 'velocity_vectors:2']].to_numpy()
+    magnetisation, points = read_magnetisation_columns(file_path, dtype=dtype)
+    if scale != 1:
+        points = points * points.dtype.type(scale)
+    return magnetisation, points
+
+
+def get_file_list(file_paths):
+    """Gets the sorted list of files matching the glob pattern, or the list itself if a list is given.
+
+    Args:
+        file_paths (str or list of str): Glob pattern or list of file paths.
+
+    Returns:
+        list of str: File paths
+    """
+    if isinstance(file_paths, str):
+        return sorted(glob.glob(file_paths))
+    return list(file_paths)
+
+
+def iter_mesh_magnetisation(file_paths, mesh=None, scale=1, prefetch=2):
+    """Iterates over the magnetisation of many files (e.g. the time steps of a simulation).
+    The next prefetch files are loaded in background threads while the current one is processed,
+    so at most prefetch + 1 frames are held in memory.
+    If the mesh is given, the magnetisation is reshuffled to the mesh points. The shuffle indices are computed once
+    and reused for all the files with the same points.
+
+    Args:
+        file_paths (str or list of str): Glob pattern or list of file paths.
+        mesh (Mesh, optional): Mesh to which the magnetisation is reshuffled. Defaults to None.
+        scale (float, optional): Scalar by which to scale coordinates. Default is 1.
+        prefetch (int, optional): Number of files loaded in advance. Defaults to 2.
+
+    Yields:
+        tuple: file_path (str), magnetisation ((n,3) array)
+    """
+    file_paths = get_file_list(file_paths)
+    shuffle_points = None
+    shuffle_indx = None
+    with ThreadPoolExecutor(max_workers=max(prefetch, 1)) as executor:
+        futures = deque()
+        for i in range(len(file_paths)):
+            # keep the next prefetch files loading in the background
+            while len(futures) <= prefetch and i + len(futures) < len(file_paths):
+                next_path = file_paths[i + len(futures)]
+                futures.append(executor.submit(
+                    load_mesh_magnetisation, next_path, scale=scale))
+            magnetisation, points = futures.popleft().result()
+            if mesh is not None:
+                if shuffle_points is None or not np.array_equal(points, shuffle_points):
+                    shuffle_points = points
+                    shuffle_indx = mesh.get_shuffle_indx(points)
+                magnetisation = magnetisation[shuffle_indx, :]
+            yield file_paths[i], magnetisation
+
+
+def load_mesh_magnetisation_stack(file_paths, mesh=None, scale=1, dtype=np.float64, n_jobs=-1, out_path=None):
+    """Loads the magnetisation of many files (e.g. the time steps of a simulation) into one array.
+    The files are parsed in n_jobs threads, each writing its frame directly into the preallocated array.
+    If the mesh is given, the magnetisation is reshuffled to the mesh points, reusing the shuffle indices of the first file
+    for all the files with the same points.
+
+    Args:
+        file_paths (str or list of str): Glob pattern or list of file paths.
+        mesh (Mesh, optional): Mesh to which the magnetisation is reshuffled. Defaults to None.
+        scale (float, optional): Scalar by which to scale coordinates. Default is 1.
+        dtype (numpy.dtype, optional): Type of the values. Defaults to np.float64.
+        n_jobs (int, optional): Number of threads loading the files. -1 uses all the cores. Defaults to -1.
+        out_path (str, optional): Path of the .npy file to which the array is memory mapped instead of being held in memory. Defaults to None.
+
+    Returns:
+        tuple: magnetisation ((n_files,n,3) array), file paths (list of str) in the order of the frames
+    """
+    file_paths = get_file_list(file_paths)
+    if len(file_paths) == 0:
+        raise ValueError("No files to load!")
+    first_magnetisation, first_points = load_mesh_magnetisation(
+        file_paths[0], scale=scale, dtype=dtype)
+    first_shuffle_indx = None
+    n_points = first_magnetisation.shape[0]
+    if mesh is not None:
+        first_shuffle_indx = mesh.get_shuffle_indx(first_points)
+        n_points = first_shuffle_indx.size
+    shape = (len(file_paths), n_points, first_magnetisation.shape[1])
+    if out_path is None:
+        out = np.empty(shape, dtype=dtype)
     else:
-        raise DataError("Unrecognized format!")
+        out = np.lib.format.open_memmap(
+            out_path, mode='w+', dtype=dtype, shape=shape)
+
+    def load_frame(i):
+        if i == 0:
+            magnetisation, points = first_magnetisation, first_points
+        else:
+            magnetisation, points = load_mesh_magnetisation(
+                file_paths[i], scale=scale, dtype=dtype)
+        if mesh is not None:
+            if points is first_points or np.array_equal(points, first_points):
+                shuffle_indx = first_shuffle_indx
+            else:
+                shuffle_indx = mesh.get_shuffle_indx(points)
+            magnetisation = magnetisation[shuffle_indx, :]
+        out[i] = magnetisation
 
-    if 'Points:0' in data:
-        points = data.loc[:, ['Points:0', 'Points:1', 'Points:2']].to_numpy()
-    elif 'Coordinates:0' in data:
-        points = data.loc[:, ['Coordinates:0',
-                              'Coordinates:1', 'Coordinates:2']].to_numpy()
+    if n_jobs == 1 or len(file_paths) == 1:
+        for i in range(len(file_paths)):
+            load_frame(i)
     else:
-        raise DataError("Unrecognized format!")
+        Parallel(n_jobs=n_jobs, prefer='threads')(
+            delayed(load_frame)(i) for i in range(len(file_paths)))
+    if out_path is not None:
+        out.flush()
+    return out, file_paths
+
+
+def read_ovf_header(file_path):
+    """Reads the header of the OOMMF/mumax .ovf file (OVF 1.0 or 2.0).
 
-    return magnetisation, points * scale
+    Args:
+        file_path (str): Path to the file.
+
+    Returns:
+        tuple: header (dict with lowercase keys, numbers converted to float or int), data format ('binary 4', 'binary 8' or 'text'),
+            offset of the data block in bytes (after the check value of the binary data)
+    """
+    header = {}
+    with open(file_path, 'rb') as f:
+        for line in f:
+            line = line.decode('latin-1').strip()
+            if not line.startswith('#'):
+                continue
+            line = line.lstrip('#').strip()
+            key, _, value = line.partition(':')
+            key, value = key.strip().lower(), value.strip()
+            if key == 'begin' and value.lower().startswith('data'):
+                data_format = value[len('data'):].strip().lower()
+                offset = f.tell()
+                break
+            if key in ('begin', 'end') or value == '':
+                continue
+            for convert in (int, float):
+                try:
+                    value = convert(value)
+                    break
+                except ValueError:
+                    pass
+            header[key] = value
+        else:
+            raise DataError("No data in the .ovf file!")
+    header.setdefault('valuedim', 3)
+    if data_format.startswith('binary'):
+        offset += int(data_format.split()[1])
+    return header, data_format, offset
+
+
+def load_ovf(file_path, mmap_mode='r'):
+    """Loads the cell values (e.g. magnetisation) from the OOMMF/mumax .ovf file. The binary data (4 or 8 bytes) is memory mapped,
+    so only the parts of the file that are used are read.
+
+    Args:
+        file_path (str): Path to the file.
+        mmap_mode (str, optional): Memory mapping mode of the binary data (see numpy.memmap). None reads the data into memory. Defaults to 'r'.
+
+    Returns:
+        tuple: values ((nx,ny,nz,valuedim) array indexed by the cell), header (dict, see read_ovf_header)
+    """
+    header, data_format, offset = read_ovf_header(file_path)
+    shape = (header['znodes'], header['ynodes'],
+             header['xnodes'], header['valuedim'])
+    if data_format.startswith('binary'):
+        n_bytes = int(data_format.split()[1])
+        # the check value tells the byte order (little endian in OVF 2.0, big endian in OVF 1.0)
+        check_value = {4: 1234567.0, 8: 123456789012345.0}[n_bytes]
+        with open(file_path, 'rb') as f:
+            f.seek(offset - n_bytes)
+            check = f.read(n_bytes)
+        for byte_order in '<>':
+            dtype = np.dtype('{}f{}'.format(byte_order, n_bytes))
+            if np.frombuffer(check, dtype=dtype)[0] == check_value:
+                break
+        else:
+            raise DataError("Wrong check value of the binary .ovf data!")
+        if mmap_mode is None:
+            data = np.fromfile(file_path, dtype=dtype, count=int(
+                np.prod(shape)), offset=offset).reshape(shape)
+        else:
+            data = np.memmap(file_path, dtype=dtype,
+                             mode=mmap_mode, offset=offset, shape=shape)
+    elif data_format == 'text':
+        with open(file_path, 'rb') as f:
+            f.seek(offset)
+            data = np.loadtxt(f, comments='#', max_rows=int(
+                np.prod(shape[:3]))).reshape(shape)
+    else:
+        raise DataError("Unrecognized .ovf data format {}!".format(data_format))
+    # the x index changes the fastest in the file
+    return data.transpose(2, 1, 0, 3), header
+
+
+def iter_ovf(file_paths, mmap_mode='r'):
+    """Iterates over the .ovf files (e.g. the time steps of a mumax simulation), loading each one only when it is reached (see load_ovf).
+
+    Args:
+        file_paths (str or list of str): Glob pattern or list of file paths.
+        mmap_mode (str, optional): Memory mapping mode of the binary data. Defaults to 'r'.
+
+    Yields:
+        tuple: file_path (str), values ((nx,ny,nz,valuedim) array)
+    """
+    for file_path in get_file_list(file_paths):
+        values, _ = load_ovf(file_path, mmap_mode=mmap_mode)
+        yield file_path, values
+
+
+def get_ovf_points_values(values, header, points, scale=1, centred=None):
+    """Maps the .ovf cell values onto the points (e.g. Mesh.points of the mesh exported from the same simulation)
+    by computing the grid indices of the points, without matching the coordinates.
+    Points at the centres of the cells (as in the .vtu files exported from mumax) get the values of their cells.
+    Points at the corners of the cells get the average of the adjacent non-zero (inside the magnet) cells.
+
+    Args:
+        values ((nx,ny,nz,valuedim) array): Cell values (see load_ovf).
+        header (dict): Header of the .ovf file.
+        points ((n,3) array): Points at the centres or at the corners of the cells.
+        scale (float, optional): Scale of the points relative to the .ovf coordinates (see Mesh.from_file). Defaults to 1.
+        centred (bool, optional): Whether the points are at the centres of the cells. Defaults to None, which finds it
+            from the offset of the points from the grid nodes.
+
+    Returns:
+        (n,valuedim) array: Values at the points. Points outside the grid get zero.
+    """
+    shape = np.array(values.shape[:3])
+    grid_min = np.array([header['xmin'], header['ymin'], header['zmin']])
+    step = np.array([header['xstepsize'], header['ystepsize'],
+                     header['zstepsize']])
+    grid_points = (np.asanyarray(points) / scale - grid_min) / step
+    if centred is None:
+        # the centres are half a cell away from the nodes
+        offset = grid_points - np.floor(grid_points)
+        centred = np.median(np.abs(offset - 0.5)) < 0.25
+    if centred:
+        cells = np.floor(grid_points).astype(np.int64)
+        valid = np.all((cells >= 0) & (cells < shape), axis=1)
+        points_values = np.zeros((cells.shape[0], values.shape[3]))
+        points_values[valid] = values[tuple(cells[valid].T)]
+        return points_values
+    nodes = np.round(grid_points).astype(np.int64)
+    total = np.zeros((nodes.shape[0], values.shape[3]))
+    count = np.zeros(nodes.shape[0])
+    for offset in np.array(np.unravel_index(np.arange(8), (2, 2, 2))).T:
+        cells = nodes - offset
+        valid = np.all((cells >= 0) & (cells < shape), axis=1)
+        cell_values = np.asarray(values[tuple(cells[valid].T)])
+        filled = np.any(cell_values != 0, axis=1)
+        valid[valid] = filled
+        total[valid] += cell_values[filled]
+        count[valid] += 1
+    return total / np.maximum(count, 1)[:, np.newaxis]
@@ -21,6 +21,30 @@ def get_blurred_image(img, sigma=4):
     return gaussian(img, sigma=sigma)
 
 
+def set_image_background(img, background, desired_background):
+    """Converts the image to grayscale and rescales it so that the background gets the desired value.
+
+    Args:
+        img ((n,m,3) array): Colour image.
+        background (float): Background value of the image.
+        desired_background (float): Desired background value.
+
+    Returns:
+        (n,m) array: Grayscale image
+    """
+    img = rgb2gray(img)
+    if desired_background >= background:
+        new1 = background / desired_background
+        img[img > new1] = new1
+        img /= new1
+    elif desired_background < background:
+        new0 = (background - desired_background)
+        img[img < new0] = new0
+        img -= new0
+        img /= 1 - new0
+    return img
+
+
 def img2uint(img):
     """Tranforms the image from float to uint8 type.
 
@@ -1,43 +1,184 @@
+import hashlib
 import os
-from collections import Counter
 
 import meshio
 import numpy as np
 import trimesh
 from cached_property import cached_property
+from scipy import sparse
 from scipy.spatial import KDTree
 from scipy.spatial.transform import Rotation
 
+from .bvh import BVH
+from .cache import MeshCache
+from .data_loading import MAGNETISATION_COLUMNS
 
-class Mesh:
+# names of the magnetisation fields of the .vtu files (the csv columns without the component)
+MAGNETISATION_FIELDS = [columns[0].split(':')[0]
+                        for columns in MAGNETISATION_COLUMNS]
+
+
+class Pose:
+    """Pose of a structure with points, changed by translate and rotate: transformed_points = points @ rotation.T + translation.
+    The points are never changed, so everything computed from them stays valid. The points and the arrays computed from them
+    (e.g. Mesh.triangles) stay in the frame of the file, use transformed_points for the moved geometry.
+    """
+    rotation = np.eye(3)
+    translation = np.zeros(3)
+
+    @property
+    def transformed_points(self):
+        """Points moved by the pose (see translate and rotate).
+
+        Returns:
+            (n,3) array
+        """
+        if self.is_posed:
+            return self.points.dot(self.rotation.T) + self.translation
+        return self.points
+
+    @property
+    def is_posed(self):
+        """True if the structure was moved by translate or rotate.
+        """
+        return not (np.array_equal(self.rotation, np.eye(3)) and not np.any(self.translation))
+
+    def get_pose(self):
+        """Gets a copy of the current pose, which does not change when the structure is moved later.
+
+        Returns:
+            Pose
+        """
+        pose = Pose()
+        pose.rotation = np.array(self.rotation, dtype=np.float64)
+        pose.translation = np.array(self.translation, dtype=np.float64)
+        return pose
+
+    def has_pose(self, pose):
+        """Checks if the structure has the given pose.
+
+        Args:
+            pose (Pose)
+
+        Returns:
+            bool
+        """
+        return np.array_equal(self.rotation, pose.rotation) and np.array_equal(self.translation, pose.translation)
+
+    def from_mesh_frame(self, points):
+        """Moves the points from the frame of self.points to the posed frame.
+
+        Args:
+            points ((n,3) array)
+
+        Returns:
+            (n,3) array
+        """
+        return np.asanyarray(points).dot(self.rotation.T) + self.translation
+
+    def to_mesh_frame(self, points):
+        """Moves the points from the posed frame to the frame of self.points.
+
+        Args:
+            points ((n,3) array)
+
+        Returns:
+            (n,3) array
+        """
+        return (np.asanyarray(points) - self.translation).dot(self.rotation)
+
+    def direction_to_mesh_frame(self, v):
+        """Rotates the direction vector from the posed frame to the frame of self.points.
+
+        Args:
+            v ((3,) array)
+
+        Returns:
+            (3,) array
+        """
+        return np.asanyarray(v).dot(self.rotation)
+
+    def translate(self, v):
+        """Translate the structure by v. The points and everything computed from them are kept,
+        only the pose changes and the raytracing moves the beam instead.
+        The points, triangles and faces stay in the frame of the file, the moved points are transformed_points.
+
+        Parameters
+        ----------
+        v : ((3,) array)
+            Translation vector
+        """
+        self.translation = self.translation + np.asanyarray(v)
+
+    def rotate(self, v):
+        """Rotates the structure by rotation vector around the origin. The points and everything computed from them are kept,
+        only the pose changes and the raytracing rotates the beam instead.
+        The points, triangles and faces stay in the frame of the file, the moved points are transformed_points.
+
+        Parameters
+        ----------
+        v : ((3,) array)
+            Rotation vector. See scipy rotvec.
+        """
+        r = Rotation.from_rotvec(v).as_matrix()
+        self.rotation = r.dot(self.rotation)
+        self.translation = r.dot(self.translation)
+
+
+class Mesh(Pose):
     """Object for handling the GMSH .msh files information
     """
 
-    def __init__(self, points, cells, parts=0):
+    def __init__(self, points, cells, parts=0, compact=False, points_dtype=None):
         """Initializes the onbject
 
         Args:
             points ((n,3) array): points of the mesh
             cells (list of cell blocks): Cells (see meshio library)
             parts (int, optional): Which parts of the structure to take into account. Defaults to 0.
+            compact (bool, optional): If True, the tetrahedra, faces and neighbours are stored as int32 (if the mesh is small enough). 
+                The triangles are never needed for the raytracing, so they are only created if accessed directly. Defaults to False.
+            points_dtype (dtype, optional): dtype of the points, e.g. np.float32 to halve the memory of the geometry. Defaults to None (keep the dtype).
         """
-        self.points = points
+        self.points = points if points_dtype is None else np.asarray(
+            points, dtype=points_dtype)
         self.cells = cells
         self._parts = parts
+        self.compact = compact
+        self._shuffle_indx_cache = {}
+        # pose of the mesh: transformed_points = points @ rotation.T + translation
+        self.rotation = np.eye(3)
+        self.translation = np.zeros(3)
 
     @classmethod
-    def from_file(cls, file_path, parts=0, scale=1):
+    def from_file(cls, file_path, parts=0, scale=1, empty_field=None, compact=False, points_dtype=None, cache=False):
         """Create the object from file_path. Supports .msh files and .vtu files as exported by mumax.
 
         Args:
             file_path (str)
             parts (int, optional): Which parts to use. Defaults to 0.
             scale (float, optional): Scale for the coordinates. Defaults to 1.
+            empty_field (str, optional): Cell or point data of the .vtu file used to find the cells outside the magnet
+                (zero-Msat cells, where the field is zero). These cells are not meshed. If the file does not contain it, all the cells are meshed.
+                Defaults to None, which uses the first magnetisation field found (see MAGNETISATION_FIELDS).
+            compact (bool, optional): Use the compact memory layout (see Mesh). Defaults to False.
+            points_dtype (dtype, optional): dtype of the points (see Mesh). Defaults to None.
+            cache (bool or str, optional): If True, keeps the mesh, its neighbours, edge faces and bounding volume hierarchy in a binary store
+                next to the file (see MeshCache) and later loads it memory mapped instead of parsing the file. A string gives the directory of the store. Defaults to False.
 
         Returns:
             Mesh
         """
 
+        if cache:
+            mesh_cache = MeshCache(
+                file_path, cache_dir=None if cache is True else cache)
+            cache_key = mesh_cache.get_key(parts=parts, scale=scale, empty_field=empty_field, compact=compact,
+                                           points_dtype=None if points_dtype is None else np.dtype(points_dtype).str)
+            cached = mesh_cache.load(cache_key)
+            if cached is not None:
+                return cls.from_arrays(compact=compact, **cached)
+
         ext = os.path.splitext(file_path)[-1]
         if ext == ".msh":
             msh = meshio.read(file_path)
@@ -45,21 +186,130 @@ class Mesh:
             cells = msh.cells
         elif ext == ".vtu":
             msh0 = meshio.read(file_path)
-            # construct tetrahedra from cubes
-            n_cubes = msh0.cells[0].data.shape[0]
-            cube_to_tetra_idx = np.array([
-                [0, 3, 1, 4],
-                [2, 3, 1, 6],
-                [5, 6, 4, 1],
-                [7, 4, 6, 3],
-                [4, 6, 3, 1]])
-            tetra = np.vstack([msh0.cells[0].data[i, :][cube_to_tetra_idx[j, :]]
-                               for i in range(n_cubes) for j in range(5)])
+            cubes = Mesh.get_filled_cubes(msh0, empty_field)
+            tetra = Mesh.get_tetra_from_cubes(cubes)
             points = msh0.points * scale
             cells = [meshio.CellBlock(type="tetra", data=tetra), ]
         else:
             raise ValueError("File format not recognized!")
-        return cls(points, cells, parts=parts)
+        mesh = cls(points, cells, parts=parts,
+                   compact=compact, points_dtype=points_dtype)
+        if cache:
+            mesh_cache.save(cache_key, mesh)
+        return mesh
+
+    @classmethod
+    def from_arrays(cls, points, tetra, tetra_neighbours=None, edge_faces=None, bvh=None, compact=False,
+                    parts=None, part_offsets=None):
+        """Creates the mesh from the arrays of the tetrahedra and the already computed derived data (e.g. loaded by MeshCache).
+
+        Args:
+            points ((n,3) array): points of the mesh
+            tetra ((m,4) array): tetrahedra of the mesh
+            tetra_neighbours ((m,4) array, optional): See Mesh.tetra_neighbours. Computed when needed if not given. Defaults to None.
+            edge_faces ((k,3) array, optional): See Mesh.edge_faces. Computed when needed if not given. Defaults to None.
+            bvh (BVH, optional): See Mesh.bvh. Its faces are used as the faces of the mesh. Defaults to None.
+            compact (bool, optional): See Mesh. Defaults to False.
+            parts (list of int, optional): Part numbers of the blocks of tetra. Defaults to None (single part 0).
+            part_offsets ((len(parts)+1,) array, optional): Offsets of the parts in tetra. Defaults to None.
+
+        Returns:
+            Mesh
+        """
+        if parts is None:
+            parts = [0]
+            part_offsets = [0, tetra.shape[0]]
+        parts = [int(part) for part in parts]
+        # the cell blocks of the parts are views of tetra
+        cells = [meshio.CellBlock(type="tetra", data=tetra[:0])
+                 for _ in range(max(parts) + 1)]
+        for part, start, stop in zip(parts, part_offsets[:-1], part_offsets[1:]):
+            cells[part] = meshio.CellBlock(
+                type="tetra", data=tetra[start:stop])
+        mesh = cls(points, cells, parts=parts, compact=compact)
+        # fill the cached properties
+        mesh.__dict__['tetra'] = tetra
+        mesh.__dict__['part_offsets'] = np.asarray(part_offsets)
+        derived = dict(tetra_neighbours=tetra_neighbours,
+                       edge_faces=edge_faces, bvh=bvh)
+        if bvh is not None:
+            derived['faces'] = bvh.faces
+        mesh.__dict__.update(
+            {name: value for name, value in derived.items() if value is not None})
+        return mesh
+
+    @staticmethod
+    def get_filled_cubes(msh, empty_field=None):
+        """Gets the cubes of the mumax .vtu mesh without the cubes outside of the magnet, where the empty_field is zero.
+        With point data, a cube is kept only if the field is non-zero at all its points (as with the threshold filter in ParaView).
+
+        Args:
+            msh (meshio.Mesh): Mesh read from the .vtu file.
+            empty_field (str, optional): Cell or point data used to find the empty cells. If the mesh does not contain it, all the cubes are returned.
+                Defaults to None, which uses the first magnetisation field found (see MAGNETISATION_FIELDS).
+
+        Returns:
+            (n,8) array: Point indices of the cubes.
+        """
+        cubes = msh.cells[0].data
+        if empty_field is None:
+            empty_field = next((name for name in MAGNETISATION_FIELDS
+                                if name in msh.cell_data or name in msh.point_data), None)
+        if empty_field in msh.cell_data:
+            values = msh.cell_data[empty_field][0].reshape(
+                cubes.shape[0], -1)
+            cubes = cubes[np.any(values != 0, axis=1)]
+        elif empty_field in msh.point_data:
+            filled_points = Mesh.get_filled_points(msh, empty_field)
+            cubes = cubes[np.all(filled_points[cubes], axis=1)]
+        return cubes
+
+    @staticmethod
+    def get_filled_points(msh, empty_field=None):
+        """Gets the points of the mumax .vtu mesh inside the magnet, where the empty_field is non-zero.
+        With cell data, these are the points of the filled cubes (see get_filled_cubes).
+
+        Args:
+            msh (meshio.Mesh): Mesh read from the .vtu file.
+            empty_field (str, optional): Cell or point data used to find the empty points. Defaults to None (see get_filled_cubes).
+
+        Returns:
+            (n,) bool array: True for the points inside the magnet.
+        """
+        if empty_field is None:
+            empty_field = next((name for name in MAGNETISATION_FIELDS
+                                if name in msh.cell_data or name in msh.point_data), None)
+        if empty_field in msh.point_data:
+            values = msh.point_data[empty_field].reshape(
+                msh.points.shape[0], -1)
+            return np.any(values != 0, axis=1)
+        filled = np.zeros(msh.points.shape[0], dtype=bool)
+        filled[Mesh.get_filled_cubes(msh, empty_field)] = True
+        return filled
+
+    @staticmethod
+    def get_tetra_from_cubes(cubes, chunk_size=2**20):
+        """Splits each cube (hexahedron with the VTK point ordering) into 5 tetrahedra.
+
+        Args:
+            cubes ((n,8) array): Point indices of the cubes.
+            chunk_size (int, optional): Number of cubes converted at once, limiting the temporary memory. Defaults to 2**20.
+
+        Returns:
+            (5n,4) int32 array: Point indices of the tetrahedra.
+        """
+        cube_to_tetra_idx = np.array([
+            [0, 3, 1, 4],
+            [2, 3, 1, 6],
+            [5, 6, 4, 1],
+            [7, 4, 6, 3],
+            [4, 6, 3, 1]])
+        n_cubes = cubes.shape[0]
+        tetra = np.empty((n_cubes, 5, 4), dtype=np.int32)
+        for start in range(0, n_cubes, chunk_size):
+            stop = min(start + chunk_size, n_cubes)
+            tetra[start:stop] = cubes[start:stop][:, cube_to_tetra_idx]
+        return tetra.reshape(-1, 4)
 
     @cached_property
     def tetra(self):
@@ -70,9 +320,130 @@ class Mesh:
         """
         tetra_list = [cb.data for cb in self.cells if cb.type == 'tetra']
         if isinstance(self._parts, (list, tuple)):
-            return np.vstack([tetra_list[i] for i in self._parts])
+            tetra = np.vstack([tetra_list[i] for i in self._parts])
+        else:
+            tetra = tetra_list[self._parts]
+        if self.compact:
+            tetra = tetra.astype(self.index_dtype, copy=False)
+        return tetra
+
+    @property
+    def part_ids(self):
+        """Numbers of the parts (tetra cell blocks) of the mesh in the order of their tetrahedra.
+
+        Returns:
+            list of int
+        """
+        if isinstance(self._parts, (list, tuple)):
+            return list(self._parts)
+        return [self._parts]
+
+    @cached_property
+    def part_offsets(self):
+        """Offsets of the parts in the tetrahedra: tetrahedra of the part part_ids[i] are tetra[part_offsets[i]:part_offsets[i+1]].
+
+        Returns:
+            (n_parts+1,) array
+        """
+        tetra_list = [cb.data for cb in self.cells if cb.type == 'tetra']
+        counts = [tetra_list[i].shape[0] for i in self.part_ids]
+        return np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+
+    def get_tetra_parts(self, tetra_indices, positions=False):
+        """Gets the parts of the tetrahedra.
+
+        Args:
+            tetra_indices (array): Indices of the tetrahedra.
+            positions (bool, optional): If True, returns the positions of the parts in part_ids instead of the part numbers. Defaults to False.
+
+        Returns:
+            array: Part of each tetrahedron.
+        """
+        pos = np.searchsorted(self.part_offsets, tetra_indices, side='right') - 1
+        if positions:
+            return pos
+        return np.asarray(self.part_ids)[pos]
+
+    @cached_property
+    def part_edge_faces(self):
+        """Faces on the edge of each part, i.e. faces on the edge of the mesh or shared with another part, oriented out of the part.
+
+        Returns:
+            tuple: faces ((k,3) array) sorted by part, offsets ((n_parts+1,) array) of the parts in the faces.
+        """
+        neighbours = self.tetra_neighbours.ravel()
+        face_part = self.get_tetra_parts(
+            np.arange(neighbours.size) // 4, positions=True)
+        neighbour_part = np.where(
+            neighbours >= 0, self.get_tetra_parts(neighbours, positions=True), -1)
+        is_edge = face_part != neighbour_part
+        faces = Mesh.orient_faces_outward(self.faces[is_edge], self.points,
+                                          self.tetra.ravel()[is_edge])
+        # the faces are in the order of the tetrahedra, so already sorted by part
+        offsets = np.searchsorted(
+            face_part[is_edge], np.arange(len(self.part_ids) + 1))
+        return faces, offsets
+
+    def get_part_edge_faces(self, part):
+        """Faces on the edge of the part (see part_edge_faces).
+
+        Args:
+            part (int): Part number.
+
+        Returns:
+            (k,3) array
+        """
+        faces, offsets = self.part_edge_faces
+        i = self.part_ids.index(part)
+        return faces[offsets[i]:offsets[i + 1]]
+
+    def get_part(self, parts):
+        """Gets the mesh of a subset of the parts, sharing the points and the connectivity of this mesh.
+        The tetrahedra and faces of consecutive parts are views of the arrays of this mesh and the neighbours are remapped without searching the faces again.
+
+        Args:
+            parts (int or list of int): Part numbers.
+
+        Returns:
+            Mesh
+        """
+        parts = list(parts) if isinstance(parts, (list, tuple)) else [parts]
+        pos = np.array([self.part_ids.index(part) for part in parts])
+        starts, stops = self.part_offsets[pos], self.part_offsets[pos + 1]
+        part_offsets = np.concatenate([[0], np.cumsum(stops - starts)])
+        if np.all(starts[1:] == stops[:-1]):
+            tetra = self.tetra[starts[0]:stops[-1]]
+            faces = self.faces[4 * starts[0]:4 * stops[-1]]
+            neighbours = self.tetra_neighbours[starts[0]:stops[-1]]
         else:
-            return tetra_list[self._parts]
+            tetra = np.vstack([self.tetra[a:b] for a, b in zip(starts, stops)])
+            faces = np.vstack([self.faces[4 * a:4 * b]
+                               for a, b in zip(starts, stops)])
+            neighbours = np.vstack([self.tetra_neighbours[a:b]
+                                    for a, b in zip(starts, stops)])
+        # move the neighbour indices to the new tetrahedra and drop the neighbours in the other parts
+        local_start = np.full(len(self.part_ids), -1, dtype=np.int64)
+        local_start[pos] = part_offsets[:-1]
+        neighbour_pos = self.get_tetra_parts(neighbours, positions=True)
+        new_neighbours = neighbours - \
+            self.part_offsets[neighbour_pos] + local_start[neighbour_pos]
+        new_neighbours[(neighbours < 0) | (local_start[neighbour_pos] < 0)] = -1
+        mesh = Mesh.from_arrays(self.points, tetra, tetra_neighbours=new_neighbours.astype(neighbours.dtype),
+                                compact=self.compact, parts=parts, part_offsets=part_offsets)
+        mesh.__dict__['faces'] = faces
+        mesh.rotation = self.rotation
+        mesh.translation = self.translation
+        return mesh
+
+    @property
+    def index_dtype(self):
+        """dtype of the indices of points, faces and tetrahedra. int32 in the compact mode if all the faces can be indexed with it, otherwise int64.
+        """
+        n_faces = 4 * sum(cb.data.shape[0]
+                          for cb in self.cells if cb.type == 'tetra')
+        if self.compact and max(n_faces, self.points.shape[0]) < 2**31:
+            return np.int32
+        return np.int64
 
     @cached_property
     def faces(self):
@@ -86,13 +457,58 @@ class Mesh:
 
     @cached_property
     def triangles(self):
-        """Triangles representing tetrahedra faces.
+        """Triangles representing tetrahedra faces, in the frame of the points (see transformed_points).
 
         Returns:
             (n,3,3) array: Points of triangles.
         """
         return np.moveaxis(np.stack([self.points[self.faces[:, i], :] for i in range(3)]), 0, 1)
 
+    def iter_triangles(self, chunk_size=2**20):
+        """Iterates over the triangles representing tetrahedra faces in chunks, without creating the whole triangles array.
+
+        Args:
+            chunk_size (int, optional): Number of triangles in a chunk. Defaults to 2**20.
+
+        Yields:
+            (chunk_size,3,3) array: Points of triangles.
+        """
+        for start in range(0, self.faces.shape[0], chunk_size):
+            yield self.points[self.faces[start:start + chunk_size], :]
+
+    @cached_property
+    def tetra_averaging_operator(self):
+        """Sparse matrix averaging the per-vertex values over the vertices of each tetrahedron.
+
+        Returns:
+            (n_tetra, n_vertices) scipy.sparse.csr_matrix
+        """
+        n_tetra = self.tetra.shape[0]
+        return sparse.csr_matrix((np.full(4 * n_tetra, 0.25), (np.repeat(np.arange(n_tetra), 4), self.tetra.ravel())),
+                                 shape=(n_tetra, self.points.shape[0]))
+
+    def get_tetra_values(self, values):
+        """Averages the per-vertex values (e.g. magnetisation) over the vertices of each tetrahedron using tetra_averaging_operator.
+
+        Args:
+            values ((n,...) array): Per-vertex values, e.g. (n,3) magnetisation or (n,3,k) stack of frames.
+
+        Returns:
+            (n_tetra,...) array
+        """
+        values = np.asanyarray(values)
+        flat = values.reshape(values.shape[0], -1)
+        return (self.tetra_averaging_operator @ flat).reshape((-1,) + values.shape[1:])
+
+    @cached_property
+    def bvh(self):
+        """Bounding volume hierarchy of the faces of the mesh used for raytracing. In the compact mode its node bounds are float32.
+
+        Returns:
+            BVH
+        """
+        return BVH(self.points, self.faces, bounds_dtype=np.float32 if self.compact else np.float64)
+
     @staticmethod
     def get_faces_from_tetra(tetra):
         selector = np.arange(4)
@@ -101,38 +517,90 @@ class Mesh:
         faces = np.swapaxes(faces, 0, 1).reshape(-1, 3)
         return faces
 
+    @cached_property
+    def tetra_neighbours(self):
+        """Face-sharing adjacency of the tetrahedra. Element [k, i] is the index of the tetrahedron
+        sharing the face of tetrahedron k opposite to its vertex i (i.e. the face self.faces[4*k + i]), or -1 if that face is on the edge of the mesh.
+
+        Returns:
+            (n,4) array of tetrahedra indices.
+        """
+        return Mesh.get_neighbours_from_faces(self.faces).astype(self.index_dtype, copy=False)
+
+    @staticmethod
+    def get_neighbours_from_faces(faces):
+        # sort the points of each face so that the shared faces become identical rows
+        faces_sorted = np.sort(faces, axis=1)
+        order = np.lexsort(faces_sorted.T[::-1])
+        faces_sorted = faces_sorted[order]
+        shared = np.flatnonzero(
+            (faces_sorted[1:] == faces_sorted[:-1]).all(axis=1))
+        neighbours = np.full(faces.shape[0], -1, dtype=np.int64)
+        neighbours[order[shared]] = order[shared + 1] // 4
+        neighbours[order[shared + 1]] = order[shared] // 4
+        return neighbours.reshape(-1, 4)
+
     @cached_property
     def edge_faces(self):
-        """Gets the faces of the tetra that are on the outside of the mesh
+        """Gets the faces of the tetra that are on the outside of the mesh.
+        The faces are oriented so that their normals (right hand rule) point out of the mesh.
 
         Returns:
             (m,3) array: Faces on the edge of the mesh 
         """
-        # edge faces are faces that appear in only one tetrahedron
-        faces_sets = [frozenset(fc) for fc in self.faces]
-        edge_faces = []
-        for item, count in Counter(faces_sets).most_common():
-            if count == 1:
-                edge_faces.append(item)
-        return np.array([list(it) for it in edge_faces])
+        # edge faces are faces that have no neighbouring tetrahedron
+        is_edge = self.tetra_neighbours.ravel() == -1
+        return Mesh.orient_faces_outward(self.faces[is_edge], self.points,
+                                         self.tetra.ravel()[is_edge])
+
+    @staticmethod
+    def orient_faces_outward(faces, points, opposite_points):
+        # face 4*k + i is opposite to the vertex i of tetrahedron k, so the outward normal points away from it
+        a = points[faces[:, 0], :]
+        normals = np.cross(points[faces[:, 1], :] - a,
+                           points[faces[:, 2], :] - a)
+        inward = np.einsum(
+            'ij,ij->i', normals, points[opposite_points, :] - a) > 0
+        faces = faces.copy()
+        faces[inward, 1], faces[inward, 2] = faces[inward, 2], faces[inward, 1]
+        return faces
 
     @cached_property
     def edge_points_indices(self):
         """Indices of the points on the edges of the mesh
+
+        Returns:
+            (m,) array: Sorted point indices.
         """
-        return set.union(*[set(ef) for ef in self.edge_faces])
+        return np.unique(self.edge_faces)
 
     def get_bounding_struct(self, fix=False):
         """STL file consisting of the faces on the edge of the mesh. If fix=True, uses trimesh to fix the normals of the faces.
         """
-        struct = trimesh.Trimesh(vertices=self.points,
+        struct = trimesh.Trimesh(vertices=self.transformed_points,
                                  faces=self.edge_faces, process=False)
         if fix:
             trimesh.repair.fix_winding(struct)
             trimesh.repair.fix_inversion(struct)
         return struct
 
-    def get_shuffle_indx(self, points):
+    @cached_property
+    def min_edge_length(self):
+        """Length of the shortest edge of the tetrahedra.
+
+        Returns:
+            float
+        """
+        min_length = np.inf
+        for start in range(0, self.tetra.shape[0], 2**18):
+            pts = self.points[self.tetra[start:start + 2**18]]
+            for i, j in ((0, 1), (0, 2), (0, 3), (1, 2), (1, 3), (2, 3)):
+                lengths = np.linalg.norm(
+                    pts[:, i].astype(np.float64) - pts[:, j], axis=1)
+                min_length = min(min_length, lengths.min())
+        return float(min_length)
+
+    def get_shuffle_indx(self, points, method='hash', tol=0.25):
         """Finds the indices such that points[shuffle_indx, :] = self.points.
 
         This is only necessary when due to the file containing multiple parts, 
@@ -140,33 +608,79 @@ class Mesh:
         These indices can be used to reshuffle the magnetisation:
         magnetisation = magnetisation[shuffle_indx, :]
 
+        The indices are cached, so the files with the same points (e.g. the time steps of a simulation) reuse them.
+
         Args:
             points ((n, 3) array): Points to be shuffled.
+            method (str, optional): 'hash' rounds the coordinates to integer keys on a grid of tol times the shortest edge of the mesh and matches the keys exactly, 
+                only the points that do not match (e.g. rounded across a grid line) are then found with a KDTree. 
+                'kdtree' finds all the points with a KDTree. Defaults to 'hash'.
+            tol (float, optional): Grid step of the 'hash' method relative to the shortest edge of the mesh (see min_edge_length).
+                It should be larger than the rounding of the exported points. Defaults to 0.25.
 
         Returns:
             (n,) array: Indices of the shuffled array
         """
+        if method not in ('hash', 'kdtree'):
+            raise ValueError("Unknown matching method {}!".format(method))
+        points = np.asanyarray(points)
+        h = hashlib.sha1(method.encode())
+        for arr in (points, self.points, [tol]):
+            h.update(np.ascontiguousarray(arr, dtype=np.float64).tobytes())
+        key = h.hexdigest()
+        if key not in self._shuffle_indx_cache:
+            if method == 'hash':
+                # the points closer than half of the shortest edge can only be the same point
+                shuffle_indx = Mesh.match_points_hashed(self.points, points, tol * self.min_edge_length,
+                                                        max_distance=self.min_edge_length / 2)
+            else:
+                shuffle_indx = Mesh.match_points_kdtree(self.points, points)
+            # only keep the latest few point layouts
+            while len(self._shuffle_indx_cache) >= 4:
+                self._shuffle_indx_cache.pop(
+                    next(iter(self._shuffle_indx_cache)))
+            self._shuffle_indx_cache[key] = shuffle_indx
+        return self._shuffle_indx_cache[key]
+
+    @staticmethod
+    def match_points_kdtree(target_points, points):
         kd = KDTree(points)
-        _, shuffle_indx = kd.query(self.points, eps=1e-2, p=1)
+        _, shuffle_indx = kd.query(target_points, eps=1e-2, p=1)
         return shuffle_indx
 
-    def translate(self, v):
-        """Translate the structure by v
-
-        Parameters
-        ----------
-        v : ((3,) array)
-            Translation vector
-        """
-        self.points += v
-
-    def rotate(self, v):
-        """Rotates the structure by rotation vector
-
-        Parameters
-        ----------
-        v : ((3,) array)
-            Rotation vector. See scipy rotvec.
-        """
-        r = Rotation.from_rotvec(v)
-        self.points = self.points.dot(r.as_matrix().T)
+    @staticmethod
+    def match_points_hashed(target_points, points, step, max_distance=None):
+        target_points = np.asarray(target_points, dtype=np.float64)
+        points = np.asarray(points, dtype=np.float64)
+        if target_points.shape[0] < 2 or points.shape[0] == 0:
+            return Mesh.match_points_kdtree(target_points, points)
+        lo = np.minimum(target_points.min(axis=0), points.min(axis=0))
+        if not step > 0 or not np.isfinite(step):
+            return Mesh.match_points_kdtree(target_points, points)
+        keys = np.round(
+            (np.vstack([target_points, points]) - lo) / step).astype(np.int64)
+        n_target = target_points.shape[0]
+        # combine the three coordinates into a single integer key if it fits
+        sizes = keys.max(axis=0) + 1
+        if np.prod(sizes.astype(np.float64)) < 2**63:
+            keys = (keys[:, 0] * sizes[1] + keys[:, 1]) * sizes[2] + keys[:, 2]
+        else:
+            _, keys = np.unique(keys, axis=0, return_inverse=True)
+            keys = keys.ravel()
+        target_keys, point_keys = keys[:n_target], keys[n_target:]
+        # join the keys of the two point sets with a sort
+        order = np.argsort(point_keys)
+        point_keys = point_keys[order]
+        found = np.minimum(np.searchsorted(
+            point_keys, target_keys), point_keys.size - 1)
+        shuffle_indx = np.where(
+            point_keys[found] == target_keys, order[found], -1)
+        # a coarse step can put several points on the same key, so only keep the close matches
+        if max_distance is None:
+            max_distance = step
+        distance = np.linalg.norm(points[shuffle_indx] - target_points, axis=1)
+        unmatched = (shuffle_indx == -1) | (distance > max_distance)
+        if np.any(unmatched):
+            shuffle_indx[unmatched] = Mesh.match_points_kdtree(
+                target_points[unmatched], points)
+        return shuffle_indx
@@ -1,4 +1,4 @@
-from .image import get_blurred_image
+from .image import get_blurred_image, set_image_background
 from .color import *
 from pyqtgraph.Qt import QtCore, QtWidgets
 import pyqtgraph.opengl as gl
@@ -227,18 +227,8 @@ class MeshVisualizer(PyQtVisualizer):
 
         img = self.get_image_np()
         if desired_background is not None:
-            img = rgb2gray(img)
-            background = self.background_color
-            if desired_background >= background:
-                new1 = background / desired_background
-                img[img > new1] = new1
-                img /= new1
-            elif desired_background < background:
-                new0 = (background - desired_background)
-                (1 - desired_background)
-                img[img < new0] = new0
-                img -= new0
-                img /= 1 - new0
+            img = set_image_background(
+                img, self.background_color, desired_background)
 
         return get_blurred_image(img, sigma=sigma)
 
@@ -0,0 +1,248 @@
+import numpy as np
+from cached_property import cached_property
+from scipy import sparse
+
+from .mesh import Mesh
+from .raytracing import RayTracing
+
+# corners of the unit cube in the VTK hexahedron order (see Mesh.get_tetra_from_cubes)
+CUBE_CORNERS = np.array([
+    [0, 0, 0],
+    [1, 0, 0],
+    [1, 1, 0],
+    [0, 1, 0],
+    [0, 0, 1],
+    [1, 0, 1],
+    [1, 1, 1],
+    [0, 1, 1]])
+
+
+class MeshPreview():
+    """Coarse voxelized version of a mesh for quickly previewing the xmcd, e.g. when looking for the beam angles.
+    The bounding box of the mesh is split into cubes so that the coarse mesh has approximately target_tetra tetrahedra.
+    The cubes with the centre inside the mesh are split into 5 tetrahedra each, and the magnetisation
+    is transferred to the coarse mesh by averaging it over the tetrahedra in each cube.
+
+        Args:
+            mesh (Mesh)
+            target_tetra (int, optional): Approximate number of tetrahedra of the coarse mesh. Defaults to 100000.
+    """
+
+    def __init__(self, mesh, target_tetra=100000):
+        self.mesh = mesh
+        self.target_tetra = target_tetra
+
+    @cached_property
+    def tetra_volumes(self):
+        """Volumes of the tetrahedra of the mesh.
+
+        Returns:
+            (n_tetra,) array
+        """
+        pts = self.mesh.points[self.mesh.tetra]
+        return np.abs(np.einsum('ij,ij->i', np.cross(pts[:, 1] - pts[:, 0], pts[:, 2] - pts[:, 0]),
+                                pts[:, 3] - pts[:, 0])) / 6
+
+    @cached_property
+    def grid(self):
+        """Grid of the cubes covering the bounding box of the mesh.
+
+        Returns:
+            tuple: corner of the grid ((3,) array), cube size ((3,) array), number of cubes along each axis ((3,) array)
+        """
+        lo = self.mesh.points.min(axis=0).astype(np.float64)
+        extent = np.ptp(self.mesh.points, axis=0).astype(np.float64)
+        # 5 tetrahedra per cube
+        n_cubes = max(self.target_tetra / 5, 1)
+        size = (self.tetra_volumes.sum() / n_cubes)**(1 / 3)
+        # thin dimensions get at least one cube
+        shape = np.maximum(np.round(extent / size), 1).astype(np.int64)
+        return lo, np.where(extent > 0, extent / shape, 1.), shape
+
+    @cached_property
+    def containing_tetra(self):
+        """Tetrahedra of the mesh containing the centres of the cubes of the grid.
+        A line is cast through each column of cubes along the longest axis of the grid, and the centres
+        between the entry and the exit of the line into a tetrahedron are inside it.
+
+        Returns:
+            (n_cubes,) array: Index of the tetrahedron containing the centre of each cube (flattened grid index) or -1 if it is outside the mesh.
+        """
+        lo, size, shape = self.grid
+        axis = np.argmax(shape)
+        column_shape = shape.copy()
+        column_shape[axis] = 1
+        column_idx = np.array(np.unravel_index(
+            np.arange(np.prod(column_shape)), column_shape)).T
+        origins = lo + (column_idx + 0.5) * size
+        origins[:, axis] = lo[axis]
+        index_ray, index_tri, t = self.mesh.bvh.intersect(
+            origins, np.eye(3)[axis])
+        # entry and exit of each line into each tetrahedron
+        index_tetra = index_tri // 4
+        order = np.lexsort((t, index_tetra, index_ray))
+        index_ray, index_tetra, t = index_ray[order], index_tetra[order], t[order]
+        new_group = np.ones(index_ray.size, dtype=bool)
+        new_group[1:] = (index_ray[1:] != index_ray[:-1]) | (
+            index_tetra[1:] != index_tetra[:-1])
+        starts = np.flatnonzero(new_group)
+        ends = np.append(starts[1:], index_ray.size) - 1
+        # cubes of the column with the centre between the entry and the exit
+        first = np.maximum(
+            np.ceil(t[starts] / size[axis] - 0.5), 0).astype(np.int64)
+        last = np.minimum(
+            np.floor(t[ends] / size[axis] - 0.5), shape[axis] - 1).astype(np.int64)
+        counts = np.maximum(last - first + 1, 0)
+        segment = np.repeat(np.arange(starts.size), counts)
+        cube_idx = column_idx[index_ray[starts[segment]]]
+        cube_idx[:, axis] = first[segment] + np.arange(segment.size) - \
+            np.repeat(np.cumsum(counts) - counts, counts)
+        containing = np.full(np.prod(shape), -1, dtype=np.int64)
+        containing[np.ravel_multi_index(cube_idx.T, shape)] = \
+            index_tetra[starts[segment]]
+        return containing
+
+    @cached_property
+    def voxels(self):
+        """Cubes of the grid with the centre inside the mesh and the transfer of the tetrahedra of the mesh to them.
+        Each cube averages the tetrahedra with the centres inside it weighted by their volume,
+        or takes the tetrahedron containing its centre if it is smaller than the tetrahedra.
+
+        Returns:
+            tuple: grid indices of the filled cubes ((k,3) array), transfer ((k, n_tetra) scipy.sparse.csr_matrix)
+        """
+        lo, size, shape = self.grid
+        containing = self.containing_tetra
+        filled = np.flatnonzero(containing >= 0)
+        cube_idx = np.array(np.unravel_index(filled, shape)).T
+        filled_pos = np.full(containing.size, -1, dtype=np.int64)
+        filled_pos[filled] = np.arange(filled.size)
+
+        # volume weighted average of the tetrahedra with the centre in the filled cubes
+        centres = self.mesh.points[self.mesh.tetra].mean(axis=1)
+        tetra_cube = np.ravel_multi_index(np.clip(np.floor((centres - lo) / size).astype(np.int64),
+                                                  0, shape - 1).T, shape)
+        tetra_pos = filled_pos[tetra_cube]
+        used = tetra_pos >= 0
+        volumes = self.tetra_volumes
+        cube_volumes = np.bincount(tetra_pos[used], weights=volumes[used],
+                                   minlength=filled.size)
+        # the cubes without any tetrahedron centre take the containing tetrahedron
+        empty = np.flatnonzero(cube_volumes == 0)
+        rows = np.concatenate([tetra_pos[used], empty])
+        cols = np.concatenate([np.flatnonzero(used), containing[filled[empty]]])
+        weights = np.concatenate([volumes[used] / cube_volumes[tetra_pos[used]],
+                                  np.ones(empty.size)])
+        transfer = sparse.csr_matrix((weights, (rows, cols)),
+                                     shape=(filled.size, volumes.size))
+        return cube_idx, transfer
+
+    @cached_property
+    def coarse_mesh(self):
+        """Coarse tetrahedral mesh made from the filled cubes. It has the same pose as the mesh.
+
+        Returns:
+            Mesh
+        """
+        lo, size, shape = self.grid
+        cube_idx, _ = self.voxels
+        corners = cube_idx[:, np.newaxis, :] + CUBE_CORNERS[np.newaxis, :, :]
+        flat_corners = np.ravel_multi_index(
+            corners.reshape(-1, 3).T, shape + 1)
+        point_ids, cubes = np.unique(flat_corners, return_inverse=True)
+        cubes = cubes.reshape(-1, 8)
+        # mirror every other cube so that the face diagonals of the neighbouring cubes match
+        odd = cube_idx.sum(axis=1) % 2 == 1
+        cubes[odd] = cubes[odd][:, [1, 0, 3, 2, 5, 4, 7, 6]]
+        points = lo + np.array(np.unravel_index(point_ids, shape + 1)).T * size
+        tetra = Mesh.get_tetra_from_cubes(cubes)
+        coarse_mesh = Mesh.from_arrays(points, tetra)
+        coarse_mesh.rotation = self.mesh.rotation
+        coarse_mesh.translation = self.mesh.translation
+        return coarse_mesh
+
+    @cached_property
+    def transfer_operator(self):
+        """Sparse matrix mapping the per-vertex values of the mesh to the per-vertex values of the coarse mesh.
+        The vertex values are averaged over the tetrahedra, then over the tetrahedra in each cube weighted by their volume
+        and then the vertices of the coarse mesh take the average of the cubes they belong to.
+
+        Returns:
+            (n_coarse_points, n_points) scipy.sparse.csr_matrix
+        """
+        _, tetra_to_cube = self.voxels
+        n_cubes = tetra_to_cube.shape[0]
+        cube_points = self.coarse_mesh.tetra.reshape(n_cubes, 20)
+        cube_to_point = sparse.csr_matrix((np.ones(cube_points.size), (cube_points.ravel(), np.repeat(np.arange(n_cubes), 20))),
+                                          shape=(self.coarse_mesh.points.shape[0], n_cubes))
+        # each corner appears several times in the tetrahedra of the cube, so count the cubes instead
+        cube_to_point.data[:] = 1
+        cube_to_point = sparse.diags(
+            1 / np.asarray(cube_to_point.sum(axis=1)).ravel()) @ cube_to_point
+        return (cube_to_point @ tetra_to_cube @ self.mesh.tetra_averaging_operator).tocsr()
+
+    def get_magnetisation(self, magnetisation):
+        """Transfers the per-vertex magnetisation of the mesh to the coarse mesh.
+
+        Args:
+            magnetisation ((n,3) or (n,3,k) array): magnetization
+
+        Returns:
+            (n_coarse_points,3) or (n_coarse_points,3,k) array
+        """
+        magnetisation = np.asanyarray(magnetisation)
+        flat = magnetisation.reshape(magnetisation.shape[0], -1)
+        return (self.transfer_operator @ flat).reshape((-1,) + magnetisation.shape[1:])
+
+    def get_raytracing(self, p, **kwargs):
+        """Gets the raytracing of the coarse mesh.
+
+        Args:
+            p ((3,) array): Beam direction vector.
+            **kwargs: Other arguments of RayTracing.
+
+        Returns:
+            RayTracing
+        """
+        return RayTracing(self.coarse_mesh, p, **kwargs)
+
+    def estimate_error(self, raytr, magnetisation, n_rays=1000, seed=None):
+        """Estimates the error of the preview by tracing a random sample of rays through both the coarse and the full mesh.
+        The rays go through random points of the projected coarse structure.
+
+        Args:
+            raytr (RayTracing): Raytracing of the coarse mesh (see get_raytracing).
+            magnetisation ((n,3) array): magnetization of the full mesh
+            n_rays (int, optional): Number of sampled rays. Defaults to 1000.
+            seed (int, optional): Seed of the random sampling. Defaults to None.
+
+        Returns:
+            dict: n_rays, rms_error, max_error and relative_rms_error (rms error relative to the rms of the full xmcd) of the sampled rays.
+        """
+        rng = np.random.default_rng(seed)
+        triangles = raytr.struct_projected.triangles
+        area = raytr.struct_projected.area_faces
+        faces = rng.choice(area.size, size=n_rays, p=area / area.sum())
+        # uniform points in the triangles
+        r = rng.random((n_rays, 2))
+        flip = r.sum(axis=1) > 1
+        r[flip] = 1 - r[flip]
+        ray_origins = triangles[faces, 0] + r[:, :1] * (triangles[faces, 1] - triangles[faces, 0]) + \
+            r[:, 1:] * (triangles[faces, 2] - triangles[faces, 0])
+
+        full_raytr = RayTracing(self.mesh, raytr.p, n=raytr.n, x0=raytr.x0, tol=raytr.tol,
+                                method=raytr.method, n_jobs=raytr.n_jobs, executor=raytr.executor)
+        # trace both meshes with the pose of the preview raytracing
+        full_raytr.pose = raytr.pose
+        magnetisation = np.asanyarray(magnetisation)
+        full_xmcd = full_raytr.trace_rays(ray_origins) @ (
+            self.mesh.tetra_averaging_operator @ magnetisation.dot(raytr.p))
+        coarse_xmcd = raytr.trace_rays(ray_origins) @ (
+            self.coarse_mesh.tetra_averaging_operator @ self.get_magnetisation(magnetisation).dot(raytr.p))
+        error = coarse_xmcd - full_xmcd
+        rms = np.sqrt(np.mean(error**2))
+        full_rms = np.sqrt(np.mean(full_xmcd**2))
+        return {'n_rays': n_rays,
+                'rms_error': rms,
+                'max_error': np.max(np.abs(error)),
+                'relative_rms_error': rms / full_rms if full_rms > 0 else np.nan}
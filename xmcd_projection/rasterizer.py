@@ -0,0 +1,325 @@
+import numpy as np
+from joblib import Parallel, delayed
+from matplotlib import image as mpl_image
+from numba import njit
+
+from .color import get_xmcd_color
+from .image import get_blurred_image, set_image_background
+
+
+def get_view_rotation(ele, azi):
+    """Gets the rotation from the world frame to the camera frame of the pyqtgraph GLViewWidget
+    (see PyQtVisualizer.set_camera). The camera looks along -z of the camera frame, with x to the right and y up.
+
+    Args:
+        ele (float): Elevation angle in deg.
+        azi (float): Azimuthal angle in deg.
+
+    Returns:
+        (3,3) array: Rotation matrix.
+    """
+    a = np.radians(-(azi + 90))
+    b = np.radians(ele - 90)
+    rot_z = np.array([[np.cos(a), -np.sin(a), 0],
+                      [np.sin(a), np.cos(a), 0],
+                      [0, 0, 1]])
+    rot_x = np.array([[1, 0, 0],
+                      [0, np.cos(b), -np.sin(b)],
+                      [0, np.sin(b), np.cos(b)]])
+    return rot_x @ rot_z
+
+
+def project_to_screen(points, ele, azi, dist, fov, center, size):
+    """Projects the points to the screen with the orthographic camera equivalent to the pyqtgraph camera.
+    The width of the view at the center is the same as the width of the perspective view with the given distance and fov.
+
+    Args:
+        points ((n,3) array)
+        ele (float): Elevation angle in deg.
+        azi (float): Azimuthal angle in deg.
+        dist (float): Distance.
+        fov (float): fov angle in deg.
+        center ((3,) array): Center of view location.
+        size (tuple): Width and height of the image in pixels.
+
+    Returns:
+        (n,3) array: Pixel coordinates (column, row from the top) and depth (larger is closer to the camera).
+    """
+    eye = (np.asanyarray(points) - center) @ get_view_rotation(ele, azi).T
+    scale = size[0] / 2 / (dist * np.tan(np.radians(fov) / 2))
+    return np.column_stack([size[0] / 2 + eye[:, 0] * scale,
+                            size[1] / 2 - eye[:, 1] * scale,
+                            eye[:, 2]])
+
+
+@njit(cache=True, nogil=True)
+def rasterize_triangles(triangles, width, height):
+    """Rasterizes the triangles with the depth buffer. The pixels are sampled at their centres.
+
+    Args:
+        triangles ((n,3,3) array): Screen coordinates of the triangles (see project_to_screen).
+        width (int): Width of the image.
+        height (int): Height of the image.
+
+    Returns:
+        (height,width) array: Index of the closest triangle in each pixel or -1 for the background.
+    """
+    face_buffer = np.full((height, width), -1, dtype=np.int64)
+    depth_buffer = np.full((height, width), -np.inf)
+    for k in range(triangles.shape[0]):
+        x0, y0, z0 = triangles[k, 0, 0], triangles[k, 0, 1], triangles[k, 0, 2]
+        x1, y1, z1 = triangles[k, 1, 0], triangles[k, 1, 1], triangles[k, 1, 2]
+        x2, y2, z2 = triangles[k, 2, 0], triangles[k, 2, 1], triangles[k, 2, 2]
+        area = (x1 - x0) * (y2 - y0) - (x2 - x0) * (y1 - y0)
+        if area == 0:
+            continue
+        # pixels with the centres in the bounding box of the triangle
+        i_min = max(int(np.ceil(min(x0, x1, x2) - 0.5)), 0)
+        i_max = min(int(np.floor(max(x0, x1, x2) - 0.5)), width - 1)
+        j_min = max(int(np.ceil(min(y0, y1, y2) - 0.5)), 0)
+        j_max = min(int(np.floor(max(y0, y1, y2) - 0.5)), height - 1)
+        for j in range(j_min, j_max + 1):
+            py = j + 0.5
+            for i in range(i_min, i_max + 1):
+                px = i + 0.5
+                # barycentric coordinates
+                w0 = ((x2 - x1) * (py - y1) - (y2 - y1) * (px - x1)) / area
+                w1 = ((x0 - x2) * (py - y2) - (y0 - y2) * (px - x2)) / area
+                w2 = 1 - w0 - w1
+                if w0 < 0 or w1 < 0 or w2 < 0:
+                    continue
+                z = w0 * z0 + w1 * z1 + w2 * z2
+                if z > depth_buffer[j, i]:
+                    depth_buffer[j, i] = z
+                    face_buffer[j, i] = k
+    return face_buffer
+
+
+def colors_to_uint8(colors):
+    """Converts the colours to uint8 in the same way as OpenGL.
+
+    Args:
+        colors ((n,4) array): Float colours in [0,1] or uint8 colours.
+
+    Returns:
+        (n,4) array: Uint8 colours.
+    """
+    colors = np.asanyarray(colors)
+    if colors.dtype == np.uint8:
+        return colors
+    return np.round(np.clip(colors, 0, 1) * 255).astype(np.uint8)
+
+
+class MeshRasterizer():
+    """Software renderer of the structure and the projected xmcd, working like MeshVisualizer without Qt or OpenGL.
+    The faces are rasterized with NumPy and numba, using the orthographic camera equivalent to PyQtVisualizer.set_camera.
+    The rasterized faces are kept for the camera, so rendering more frames with the same camera only maps the colours.
+
+        Args:
+            struct (trimesh.Trimesh)
+            projected_struct (trimesh.Trimesh)
+            projected_xmcd ((n,) array, optional): Values of the projected
+                xmcd corresponding to the faces of the projected structure. Defaults to None.
+            struct_colors ((m,4), optional): Colours of the structure magnetization. Defaults to None.
+            dist (float, optional): Camera distance. Defaults to 10000.
+    """
+
+    def __init__(self, struct, projected_struct, projected_xmcd=None, struct_colors=None, dist=10000):
+        self.struct = struct
+        self.projected_struct = projected_struct
+        # default camera of the pyqtgraph GLViewWidget
+        self.opts = {'elevation': 30, 'azimuth': 45, 'distance': dist,
+                     'fov': 60, 'center': np.zeros(3)}
+        self.background_color = 0.5
+        self.view_background_color = self.background_color
+        self.items = set()
+        self._face_buffer_key = None
+        self._face_buffer = None
+
+        if projected_xmcd is None:
+            self.xmcd_color = np.zeros(
+                (self.projected_struct.faces.shape[0], 4))
+        else:
+            self.projected_xmcd = projected_xmcd
+            self.update_xmcd_color()
+        self.struct_colors = np.zeros(
+            (self.struct.faces.shape[0], 4)) if struct_colors is None else struct_colors
+
+        self.view_both()
+        self.set_camera(
+            azi=None, center=self.get_structs_center(), ele=90, fov=1)
+
+    def set_camera(self, ele=None, azi=None, dist=None, fov=None, center=None):
+        """Sets the camera angle and position. Any kwag that is not passed is kept as is.
+
+        Args:
+            ele (float, optional): Elevation angle. Defaults to None.
+            azi (float, optional): Azimuthal angle in deg. Defaults to None.
+            dist (float, optional): Distance. Defaults to None.
+            fov (float, optional): fov angle. Defaults to None.
+            center ((3,) array, optional): Center of view location. Defaults to None.
+        """
+        if ele is not None:
+            self.opts['elevation'] = ele
+        if azi is not None:
+            self.opts['azimuth'] = azi
+        if dist is not None:
+            self.opts['distance'] = dist
+        if fov is not None:
+            self.opts['fov'] = fov
+        if center is not None:
+            self.opts['center'] = np.array(center, dtype=np.float64)
+
+    def get_structs_center(self):
+        """Gets the centre of the structure and the projected structure
+
+        Returns:
+            (n,3) array: Centre.
+        """
+        v1 = self.struct.vertices[self.struct.faces].reshape(-1, 3)
+        v2 = self.projected_struct.vertices[self.projected_struct.faces].reshape(
+            -1, 3)
+        all_pts = np.vstack((v1, v2))
+        return (all_pts.max(axis=0) + all_pts.min(axis=0)) / 2
+
+    def update_xmcd_color(self):
+        """Updates internally the colours of the xmcd and the background.
+        """
+        mn, mx = self.projected_xmcd.min(), self.projected_xmcd.max()
+        self.xmcd_color, background_color = get_xmcd_color(
+            self.projected_xmcd, vmin=mn, vmax=mx)
+        self.background_color = background_color[0]
+
+    def update_colors(self, projected_xmcd, struct_colors):
+        """Updates the colours of the xmcd and the structure.
+
+        Args:
+            projected_xmcd ((n,) array): XMCD values of the projected structure faces.
+            struct_colors ((m,4) array): Colurs of the structure faces.
+        """
+        self.projected_xmcd = projected_xmcd
+        self.update_xmcd_color()
+        self.struct_colors = struct_colors
+
+    def view_projection(self, **kwargs):
+        """Removes the display of the structure and focuses only on the XMCD.
+        """
+        self.items = {'projected'}
+        self.view_background_color = self.background_color
+        self.set_camera(**kwargs)
+
+    def view_struct(self, **kwargs):
+        """Removes the display of the projection and focuses only on the
+        structure
+        """
+        self.items = {'struct'}
+        self.view_background_color = 1.0
+        self.set_camera(**kwargs)
+
+    def view_both(self, **kwargs):
+        """View both the projection and the structure in the same render.
+        """
+        self.items = {'struct', 'projected'}
+        self.view_background_color = self.background_color
+        self.set_camera(**kwargs)
+
+    def get_face_buffer(self, size=(1024, 1024)):
+        """Gets the faces visible in each pixel for the current camera. The result is kept until the camera or the displayed items change.
+
+        Args:
+            size (tuple, optional): Width and height of the image. Defaults to (1024, 1024).
+
+        Returns:
+            (height,width) array: Index of the face in each pixel (the structure faces followed by the projected structure faces) or -1 for the background.
+        """
+        key = (tuple(sorted(self.items)), tuple(size), self.opts['elevation'], self.opts['azimuth'],
+               self.opts['distance'], self.opts['fov'], tuple(self.opts['center']))
+        if key != self._face_buffer_key:
+            n_struct = self.struct.faces.shape[0]
+            triangles, offsets = [], []
+            if 'struct' in self.items:
+                triangles.append(self.struct.triangles)
+                offsets.append(np.arange(n_struct))
+            if 'projected' in self.items:
+                triangles.append(self.projected_struct.triangles)
+                offsets.append(
+                    n_struct + np.arange(self.projected_struct.faces.shape[0]))
+            triangles = np.concatenate(triangles).reshape(-1, 3)
+            offsets = np.concatenate(offsets)
+            screen = project_to_screen(triangles, self.opts['elevation'], self.opts['azimuth'],
+                                       self.opts['distance'], self.opts['fov'], self.opts['center'], size)
+            face_buffer = rasterize_triangles(
+                screen.reshape(-1, 3, 3), int(size[0]), int(size[1]))
+            self._face_buffer = np.where(
+                face_buffer >= 0, offsets[face_buffer], -1)
+            self._face_buffer_key = key
+        return self._face_buffer
+
+    def _render(self, face_colors, background_color, size, out=None):
+        face_buffer = self.get_face_buffer(size)
+        background = int(background_color * 255)
+        colors = np.vstack([colors_to_uint8(face_colors)[:, :3],
+                            np.full((1, 3), background, dtype=np.uint8)])
+        # the background is the last colour, so -1 picks it
+        return np.take(colors, face_buffer, axis=0, out=out)
+
+    def get_image_np(self, size=(1024, 1024)):
+        """Gets the image in the form plottable by matplotlib, like MeshVisualizer.get_image_np.
+
+        Args:
+            size (tuple, optional): Width and height of the image. Defaults to (1024, 1024).
+
+        Returns:
+            (height,width,3) array: Uint8 RGB image.
+        """
+        face_colors = np.vstack([colors_to_uint8(self.struct_colors),
+                                 colors_to_uint8(self.xmcd_color)])
+        return self._render(face_colors, self.view_background_color, size)
+
+    def save_render(self, filename, size=(1024, 1024)):
+        """Saves the render to filename with the givern resolution.
+        """
+        mpl_image.imsave(filename, self.get_image_np(size=size))
+
+    def render_xmcd_frames(self, projected_xmcd, size=(1024, 1024), n_jobs=1):
+        """Renders the xmcd of many frames (e.g. from RayTracing.get_xmcd of stacked magnetisation) with the current camera.
+        The faces are rasterized once and the frames are coloured in n_jobs threads.
+        Each frame is normalized to its own range, as in update_xmcd_color.
+
+        Args:
+            projected_xmcd ((n,k) array): XMCD values of the projected structure faces for k frames.
+            size (tuple, optional): Width and height of the images. Defaults to (1024, 1024).
+            n_jobs (int, optional): Number of threads. -1 uses all the cores. Defaults to 1.
+
+        Returns:
+            (k,height,width,3) array: Uint8 RGB images.
+        """
+        projected_xmcd = np.asanyarray(projected_xmcd)
+        n_frames = projected_xmcd.shape[1]
+        # rasterize once before the threads
+        self.get_face_buffer(size)
+        struct_colors = colors_to_uint8(self.struct_colors)
+        out = np.empty((n_frames, size[1], size[0], 3), dtype=np.uint8)
+
+        def render_frame(i):
+            xmcd_color, background_color = get_xmcd_color(
+                projected_xmcd[:, i])
+            background = background_color[0] if 'projected' in self.items else 1.0
+            self._render(np.vstack([struct_colors, colors_to_uint8(xmcd_color)]),
+                         background, size, out=out[i])
+
+        if n_jobs == 1 or n_frames <= 1:
+            for i in range(n_frames):
+                render_frame(i)
+        else:
+            Parallel(n_jobs=n_jobs, prefer='threads')(
+                delayed(render_frame)(i) for i in range(n_frames))
+        return out
+
+    def get_blurred_image(self, sigma=4, desired_background=None, size=(1024, 1024)):
+        """Applies a Gaussian blur to the image to make it correspond to the actual measurements more"""
+        img = self.get_image_np(size=size)
+        if desired_background is not None:
+            img = set_image_background(
+                img, self.background_color, desired_background)
+        return get_blurred_image(img, sigma=sigma)
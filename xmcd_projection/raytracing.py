@@ -1,10 +1,14 @@
-from warnings import warn
 import numpy as np
-from .projection import project_structure
+from .projection import project_structure, get_projection_vector
+from .cache import PiercingsCache
+from .bvh import BVH
+from .data_loading import get_file_list, iter_mesh_magnetisation
 from numba import njit
+from trimesh.constants import tol as trimesh_tol
 # from trimesh.ray.ray_triangle import ray_triangle_id
-from trimesh import triangles as triangles_mod
 from tqdm import tqdm
+from scipy import sparse
+from joblib import Parallel, delayed
 
 # tol.zero = 1e-12
 # print(tol.zero)
@@ -19,26 +23,56 @@ class RayTracing():
             n ((3,), optional): Normal to the projection plane. Defaults to [0, 0, 1].
             x0 ((3,), optional): Point on the projection plane. Defaults to the minimum point in the n direction.
             tol (float, optional): Tolerance for numerical errors. Defaults to 1e-5.
+            method (str, optional): Method for the raytracing. 'batched' traces all the rays in vectorized chunks,
+                'walk' walks the rays through the mesh from one tetrahedron to its neighbour, 'loop' casts the rays one by one. Defaults to 'batched'.
+            n_jobs (int, optional): Number of threads tracing the chunks of rays in the 'batched' and 'walk' methods. -1 uses all the cores. Defaults to 1.
+            executor (concurrent.futures.Executor, optional): Executor for tracing the chunks of rays instead of n_jobs threads.
+                The chunks share the mesh arrays and the acceleration structure, so it should run in threads. Defaults to None.
+            cache (str or PiercingsCache, optional): Directory of the on-disk cache of the projected structure and the piercings. Defaults to None (no cache).
+
+        The pose of the mesh (see Mesh.rotate) is taken when the raytracing is created, so moving the mesh afterwards
+        does not change it. Create a new raytracing for the new pose.
     """
 
-    def __init__(self, mesh, p, n=[0, 0, 1], x0=None, tol=1e-5):
+    def __init__(self, mesh, p, n=[0, 0, 1], x0=None, tol=1e-5, method='batched', n_jobs=1, executor=None, cache=None):
         self.mesh = mesh
+        if method not in ('batched', 'walk', 'loop'):
+            raise ValueError("Unknown raytracing method {}!".format(method))
+        self.method = method
+        self.n_jobs = n_jobs
+        self.executor = executor
         self.p = np.array(p) / np.linalg.norm(p)
         self.n = np.array(n) / np.linalg.norm(n)
         if self.p.dot(self.n) == 0:
             raise ValueError(
                 "Beam direction can not be parallel to the screen!")
         self.tol = tol
+        self.pose = mesh.get_pose()
         if x0 is None:
             # point of the structure the most in the negative n direction
-            min_normal_dir = np.min(self.mesh.points.dot(self.n)) - self.tol
+            min_normal_dir = np.min(self.mesh.points.dot(
+                self.pose.direction_to_mesh_frame(self.n))) + self.pose.translation.dot(self.n) - self.tol
             self.x0 = min_normal_dir*self.n
         else:
             self.x0 = np.array(x0)
 
+        if cache is None or isinstance(cache, PiercingsCache):
+            self.cache = cache
+        else:
+            self.cache = PiercingsCache(cache)
+
         self._struct = None
+        self._piercings_matrix = None
         self._piercings = None
+        self._projection_operator = None
         self._struct_projected = None
+        self._pixel_operators = {}
+
+    def __getstate__(self):
+        # executors can not be pickled
+        state = self.__dict__.copy()
+        state['executor'] = None
+        return state
 
     @property
     def piercings(self):
@@ -49,15 +83,76 @@ class RayTracing():
             list of (2,) tuple
         """
         if self._piercings is None:
-            self.get_piercings()
+            self._piercings = matrix_to_piercings(self.piercings_matrix)
         return self._piercings
 
+    @piercings.setter
+    def piercings(self, piercings):
+        # the xmcd is computed from the matrix, so set it from the list
+        self.piercings_matrix = piercings_to_matrix(
+            piercings, self.averaging_operator.shape[0])
+        self._piercings = piercings
+
+    @property
+    def piercings_matrix(self):
+        """Sparse matrix of the piercings. Element [i, j] is the length of the ray from the face i of the projected structure going through the tetrahedron j.
+
+        Returns:
+            (m, n_tetra) scipy.sparse.csr_matrix
+        """
+        if self._piercings_matrix is None:
+            self.get_piercings()
+        return self._piercings_matrix
+
+    @piercings_matrix.setter
+    def piercings_matrix(self, piercings_matrix):
+        self._piercings_matrix = sparse.csr_matrix(piercings_matrix)
+        self._piercings = None
+        self._projection_operator = None
+
+    @property
+    def piercings_parts(self):
+        """Part of the mesh (see Mesh.part_ids) of each piercing, aligned with the data of piercings_matrix
+        (and with the tetrahedra of each face in piercings).
+
+        Returns:
+            (k,) array
+        """
+        return self.mesh.get_tetra_parts(self.piercings_matrix.indices)
+
+    @property
+    def averaging_operator(self):
+        """Sparse matrix averaging the per-vertex values over the cells of the mesh crossed by the rays (see Mesh.tetra_averaging_operator).
+
+        Returns:
+            (n_tetra, n_vertices) scipy.sparse.csr_matrix
+        """
+        return self.mesh.tetra_averaging_operator
+
+    @property
+    def projection_operator(self):
+        """Sparse matrix mapping the per-vertex values of the mesh to the integrals along the rays of the projected structure faces.
+        It is the product of the piercings matrix and the averaging of the vertex values over the tetrahedra.
+
+        Returns:
+            (m, n_vertices) scipy.sparse.csr_matrix
+        """
+        if self._projection_operator is None:
+            self._projection_operator = (
+                self.piercings_matrix @ self.averaging_operator).tocsr()
+        return self._projection_operator
+
     @property
     def struct(self):
         """trimesh.Trimesh structure made from the triangles at the outside edge of the mesh
         """
         if self._struct is None:
-            self._struct = self.mesh.get_bounding_struct()
+            struct = self.mesh.get_bounding_struct()
+            if not self.mesh.has_pose(self.pose):
+                # the mesh was moved after the raytracing was created
+                struct.vertices = self.pose.from_mesh_frame(
+                    self.mesh.to_mesh_frame(struct.vertices))
+            self._struct = struct
         return self._struct
 
     @property
@@ -75,6 +170,15 @@ class RayTracing():
         Returns:
             list of tuples of arrays (lengths (n,), indices(n,)): for each triangle in the projected structure, lengths of the segment of the ray going through the tetrahedron with the given index.
         """
+        if self.cache is not None:
+            cache_key = self.cache.get_key(
+                self.mesh, self.p, self.n, self.x0, self.tol, pose=self.pose)
+            cached = self.cache.load(cache_key)
+            if cached is not None:
+                self._struct_projected, self._piercings_matrix = cached
+                self._piercings = None
+                self._projection_operator = None
+                return
         # get all the piercing data
         # use inscribed circle centre or each triangle as the ray origin
         triangles = self.struct_projected.triangles
@@ -87,38 +191,261 @@ class RayTracing():
         ray_origins = (a * triangles[:, 0, :] + b * triangles[:,
                                                               1, :] + c * triangles[:, 2, :]) / (a + b + c)
         # ray_origins = self.struct_projected.triangles_center
-        # get the ray piercings
-        self._piercings = get_points_piercings(
-            ray_origins, self.p, self.mesh.triangles, tol=self.tol)
+        self._piercings_matrix = self.trace_rays(ray_origins)
+        self._piercings = None
+        self._projection_operator = None
+        if self.cache is not None:
+            self.cache.save(cache_key, self.struct_projected,
+                            self._piercings_matrix)
+
+    def trace_rays(self, ray_origins):
+        """Traces the rays with direction self.p from the given origins through the mesh with the method of the raytracing.
+
+        Args:
+            ray_origins ((m,3) array): Origins of the rays.
+
+        Returns:
+            (m, n_tetra) scipy.sparse.csr_matrix: Element [i, j] is the length of the ray i going through the tetrahedron j.
+        """
+        n_tetra = self.mesh.tetra.shape[0]
+        # move the rays instead of the mesh, so that its points and acceleration structures are reused
+        p = self.pose.direction_to_mesh_frame(self.p)
+        ray_origins = self.pose.to_mesh_frame(ray_origins)
+        if self.method == 'walk':
+            segments = get_points_segments_walk(
+                ray_origins, p, self.mesh.points, self.mesh.tetra, self.mesh.tetra_neighbours,
+                n_jobs=self.n_jobs, executor=self.executor)
+            return segments_to_matrix(*segments, ray_origins.shape[0], n_tetra)
+        elif self.method == 'batched':
+            segments = get_points_segments(
+                ray_origins, p, None, tree=self.mesh.bvh, n_jobs=self.n_jobs, executor=self.executor)
+            return segments_to_matrix(*segments, ray_origins.shape[0], n_tetra)
+        piercings = get_points_piercings(
+            ray_origins, p, None, batched=False, tree=self.mesh.bvh)
+        return piercings_to_matrix(piercings, n_tetra)
+
+    @property
+    def plane_basis(self):
+        """Orthonormal in-plane vectors (u, v) of the projection plane. u is the x axis projected to the plane
+        (or the y axis if the normal is along x) and v = n x u, so that for the default normal u = x and v = y.
+
+        Returns:
+            (2,3) array
+        """
+        axis = np.array([1., 0, 0]) if abs(self.n[0]) < 0.9 else np.array([0., 1, 0])
+        u = axis - axis.dot(self.n) * self.n
+        u /= np.linalg.norm(u)
+        v = np.cross(self.n, u)
+        return np.array([u, v])
+
+    def get_pixel_grid(self, pixel_size, extent=None):
+        """Gets the centres of the pixels of a regular grid in the projection plane.
+
+        Args:
+            pixel_size (float): Size of the pixels in the units of the mesh.
+            extent ((4,) array, optional): (u_min, u_max, v_min, v_max) of the image in the plane coordinates (see plane_basis).
+                Defaults to the bounding box of the projected structure.
+
+        Returns:
+            tuple: pixel centres ((ny, nx, 3) array), extent ((4,) array) of the image rounded to whole pixels.
+        """
+        basis = self.plane_basis
+        if extent is None:
+            uv = np.asarray(self.struct_projected.vertices).dot(basis.T)
+            extent = [uv[:, 0].min(), uv[:, 0].max(),
+                      uv[:, 1].min(), uv[:, 1].max()]
+        u_min, u_max, v_min, v_max = extent
+        nx = max(int(np.ceil((u_max - u_min) / pixel_size)), 1)
+        ny = max(int(np.ceil((v_max - v_min) / pixel_size)), 1)
+        u = u_min + (np.arange(nx) + 0.5) * pixel_size
+        v = v_min + (np.arange(ny) + 0.5) * pixel_size
+        plane_origin = self.x0.dot(self.n) * self.n
+        centres = plane_origin + u[None, :, None] * basis[0] + \
+            v[:, None, None] * basis[1]
+        extent = np.array([u_min, u_min + nx * pixel_size,
+                           v_min, v_min + ny * pixel_size])
+        return centres, extent
+
+    def get_pixel_operator(self, pixel_size, extent=None):
+        """Gets the sparse matrix mapping the per-vertex values of the mesh to the integrals along the rays through the pixel centres.
+        The operator is computed once for each pixel grid and reused.
+
+        Args:
+            pixel_size (float): Size of the pixels in the units of the mesh.
+            extent ((4,) array, optional): Extent of the image (see get_pixel_grid). Defaults to None.
+
+        Returns:
+            tuple: operator ((ny*nx, n_vertices) scipy.sparse.csr_matrix), image shape (ny, nx), extent ((4,) array)
+        """
+        key = (pixel_size, None if extent is None else tuple(extent))
+        if key not in self._pixel_operators:
+            centres, image_extent = self.get_pixel_grid(
+                pixel_size, extent=extent)
+            pixel_piercings = self.trace_rays(centres.reshape(-1, 3))
+            operator = (pixel_piercings @
+                        self.averaging_operator).tocsr()
+            self._pixel_operators[key] = (
+                operator, centres.shape[:2], image_extent)
+        return self._pixel_operators[key]
+
+    def get_xmcd_image(self, magnetisation, pixel_size, extent=None):
+        """Gets the xmcd image by casting one ray through the centre of each pixel of a regular grid in the projection plane.
+        The cost does not depend on the density of the mesh and no rendering is needed.
+        Rows of the image go along v and columns along u (see plane_basis). Pixels outside the structure are 0.
+
+        Args:
+            magnetisation ((n,3) or (n,3,k) array): magnetization
+            pixel_size (float): Size of the pixels in the units of the mesh.
+            extent ((4,) array, optional): (u_min, u_max, v_min, v_max) of the image in the plane coordinates.
+                Defaults to the bounding box of the projected structure.
+
+        Returns:
+            tuple: image ((ny, nx) or (ny, nx, k) array), extent ((4,) array) of the image, e.g. for matplotlib imshow with origin='lower'.
+        """
+        operator, shape, image_extent = self.get_pixel_operator(
+            pixel_size, extent=extent)
+        magnetisation = np.asanyarray(magnetisation)
+        mag_p = np.tensordot(magnetisation, self.p, axes=([1], [0]))
+        xmcd = operator @ mag_p
+        return xmcd.reshape(shape + xmcd.shape[1:]), image_extent
 
     def get_xmcd(self, magnetisation):
         """Gets the xmcd data based on the per-vertex magnetization of the mesh.
+        Magnetisation of many frames can be projected at once by stacking them along the last axis.
+        The pose of the mesh (see Mesh.rotate) moves only the geometry, the magnetisation is not rotated with it.
 
         Args:
-            magnetisation ((n,3) array): magnetization
+            magnetisation ((n,3) or (n,3,k) array): magnetization
 
         Returns:
-            (m,) array: XMCD value for each face of the projected structure.
+            (m,) or (m,k) array: XMCD value for each face of the projected structure (and each frame).
         """
-        # get the mesh data
-        tetra_magnetisation = self.get_tetra_magnetisation(
-            self.mesh.tetra, magnetisation)
+        # magnetisation component along the beam
+        magnetisation = np.asanyarray(magnetisation)
+        mag_p = np.tensordot(magnetisation, self.p, axes=([1], [0]))
         # integrate over the intersected tetrahedra
-        xmcd = np.array([np.sum(tetra_magnetisation[nums, :].dot(self.p) * dist)
-                         for dist, nums in self.piercings])
-        return xmcd
+        return self.projection_operator @ mag_p
+
+    def get_xmcd_parts(self, magnetisation):
+        """Gets the contribution of each part of the mesh to the xmcd of the faces of the projected structure.
+        The contributions of all the parts sum to get_xmcd.
+
+        Args:
+            magnetisation ((n,3) array): magnetization
+
+        Returns:
+            (m, n_parts) array: XMCD of each face from the parts in the order of Mesh.part_ids.
+        """
+        mag_p = np.asanyarray(magnetisation).dot(self.p)
+        tetra_mag_p = self.mesh.get_tetra_values(mag_p)
+        n_tetra = tetra_mag_p.shape[0]
+        # sums the tetrahedra values of each part
+        part_sum = sparse.csr_matrix((tetra_mag_p, (np.arange(n_tetra), self.mesh.get_tetra_parts(np.arange(n_tetra), positions=True))),
+                                     shape=(n_tetra, len(self.mesh.part_ids)))
+        return (self.piercings_matrix @ part_sum).toarray()
+
+    def iter_xmcd(self, file_paths, scale=1, prefetch=2):
+        """Iterates over the xmcd of the magnetisation files (e.g. the time steps of a simulation).
+        The files are loaded in the background and reshuffled to the mesh points (see iter_mesh_magnetisation).
+
+        Args:
+            file_paths (str or list of str): Glob pattern or list of file paths.
+            scale (float, optional): Scalar by which to scale coordinates of the files. Default is 1.
+            prefetch (int, optional): Number of files loaded in advance. Defaults to 2.
+
+        Yields:
+            tuple: file_path (str), xmcd ((m,) array)
+        """
+        for file_path, magnetisation in iter_mesh_magnetisation(file_paths, mesh=self.mesh, scale=scale, prefetch=prefetch):
+            yield file_path, self.get_xmcd(magnetisation)
+
+    def save_xmcd(self, file_paths, out_path, scale=1, prefetch=2):
+        """Computes the xmcd of the magnetisation files and writes it frame by frame to the .npy file,
+        so the memory use does not grow with the number of files.
+
+        Args:
+            file_paths (str or list of str): Glob pattern or list of file paths.
+            out_path (str): Path of the .npy file. The saved array has shape (n_files, m).
+            scale (float, optional): Scalar by which to scale coordinates of the files. Default is 1.
+            prefetch (int, optional): Number of files loaded in advance. Defaults to 2.
+
+        Returns:
+            list of str: File paths in the order of the saved frames.
+        """
+        file_paths = get_file_list(file_paths)
+        out = np.lib.format.open_memmap(out_path, mode='w+', dtype=np.float64,
+                                        shape=(len(file_paths), self.piercings_matrix.shape[0]))
+        for i, (_, xmcd) in enumerate(self.iter_xmcd(file_paths, scale=scale, prefetch=prefetch)):
+            out[i] = xmcd
+        out.flush()
+        del out
+        return file_paths
 
     @staticmethod
     def get_tetra_magnetisation(tetra, magnetisation):
-        """Gets the magnetization of tetrahedra from per-vertex magnetisation
+        """Gets the magnetization of tetrahedra from per-vertex magnetisation.
+        For the mesh of the raytracing, use get_cell_magnetisation, which reuses the averaging operator of the mesh.
         """
-        return np.mean(
-            [magnetisation[tetra[:, i], :] for i in range(4)], axis=0)
+        return magnetisation[tetra].mean(axis=1)
+
+    def get_cell_magnetisation(self, magnetisation):
+        """Gets the magnetization of the tetrahedra (or the cells of a VoxelGrid) from per-vertex magnetisation
+        (see Mesh.get_tetra_values).
+
+        Args:
+            magnetisation ((n,3) or (n,3,k) array): magnetization
+
+        Returns:
+            (n_tetra,3) or (n_tetra,3,k) array
+        """
+        return self.mesh.get_tetra_values(magnetisation)
+
+
+def sweep_directions(mesh, directions, n=[0, 0, 1], x0=None, tol=1e-5, method='batched', n_jobs=1, cache=None):
+    """Traces the mesh along many beam directions, building the geometry shared by all of them only once.
+    The bounding structure is shared between the returned RayTracing objects and the bounding volume hierarchy of the mesh (or the tetrahedra adjacency for the 'walk' method) is built once.
+
+    Args:
+        mesh (Mesh)
+        directions ((k,2) or (k,3) array): Beam directions, either as (phi, theta) angles in degrees (see get_projection_vector) or as beam direction vectors.
+        n ((3,), optional): Normal to the projection plane. Defaults to [0, 0, 1].
+        x0 ((3,), optional): Point on the projection plane. Defaults to the minimum point in the n direction.
+        tol (float, optional): Tolerance for numerical errors. Defaults to 1e-5.
+        method (str, optional): Method for the raytracing (see RayTracing). Defaults to 'batched'.
+        n_jobs (int, optional): Number of threads tracing the directions. -1 uses all the cores. Defaults to 1.
+        cache (str or PiercingsCache, optional): Directory of the on-disk cache. Defaults to None.
+
+    Returns:
+        list of RayTracing: Raytracing for each direction with the piercings and the projected structure computed.
+    """
+    directions = np.atleast_2d(np.asanyarray(directions, dtype=np.float64))
+    if directions.shape[1] == 2:
+        directions = np.array([get_projection_vector(phi, theta)
+                               for phi, theta in directions])
+    if cache is not None and not isinstance(cache, PiercingsCache):
+        cache = PiercingsCache(cache)
+    # compute the shared geometry before the threads start
+    struct = mesh.get_bounding_struct()
+    if method == 'walk':
+        mesh.tetra_neighbours
+    else:
+        mesh.bvh
+
+    def trace_direction(p):
+        raytr = RayTracing(mesh, p, n=n, x0=x0, tol=tol,
+                           method=method, cache=cache)
+        raytr._struct = struct
+        raytr.get_piercings()
+        return raytr
+
+    if n_jobs == 1 or directions.shape[0] <= 1:
+        return [trace_direction(p) for p in directions]
+    return Parallel(n_jobs=n_jobs, prefer='threads')(delayed(trace_direction)(p) for p in directions)
 
 
 # TODO: this could be sped up using pyembree. See: https://trimsh.org/trimesh.ray.ray_pyembree.html
 # I was not able to install it on windows and this is fast enough for my structures.
-def get_points_piercings(ray_origins, p, triangles, tol=1e-3):
+def get_points_piercings(ray_origins, p, triangles, tol=1e-3, batched=True, chunk_size=4096, n_jobs=1, executor=None, tree=None):
     """Gets the ray piercings of triangles for each of the ray_origins along the vector p. 
     Returns the piercings as a list of tuples of two arrays for each of the ray origins. 
     Second array are the indices of the intersected tetrahedra and the first are the lengths of the intersections.
@@ -128,54 +455,399 @@ def get_points_piercings(ray_origins, p, triangles, tol=1e-3):
         ray_origins ((n,3) array): Origins of the rays
         p ((3,) array): Ray vector
         triangles ((n,3,3) array): Triangles
+        tol (float, optional): Not used, degenerate hits through edges and vertices are handled without moving the ray. Kept for compatibility. Defaults to 1e-3.
+        batched (bool, optional): If True, traces all the rays in chunked passes. 
+            Otherwise, casts the rays one by one. Defaults to True.
+        chunk_size (int, optional): Number of rays traced in one pass in the batched mode. Defaults to 4096.
+        n_jobs (int, optional): Number of threads tracing the chunks in the batched mode. -1 uses all the cores. Defaults to 1.
+        executor (concurrent.futures.Executor, optional): Executor for tracing the chunks in the batched mode instead of n_jobs threads. Defaults to None.
+        tree (BVH, optional): Bounding volume hierarchy of the triangles (e.g. Mesh.bvh). Built if not given. Defaults to None.
 
     Returns:
         list: piercings list
     """
-    triangles_normal = triangles_mod.normals(triangles)[0]
-    tree = triangles_mod.bounds_tree(triangles)
-
-    pnew = p[np.newaxis, :]
+    if batched:
+        return get_points_piercings_batched(ray_origins, p, triangles, chunk_size=chunk_size,
+                                            tree=tree, n_jobs=n_jobs, executor=executor)
 
-    def ray_piercing_fun(orig): return ray_triangle_id(
-        triangles, orig[np.newaxis, :], pnew, triangles_normal=triangles_normal, tree=tree)
+    if tree is None:
+        tree = BVH.from_triangles(triangles)
 
     def get_piercings_item(orig):
-        tri_id, _, locs = ray_piercing_fun(orig)
-        try:
-            return get_piercings_frompt_lengths(locs, tri_id // 4)
-        except ValueError as e:
-            warn(
-                str(e) + ' If this happens rarely, it could be a numerical artefact.')
-            # running this again with tiny random movement, if it crashes a second time, it's not an artefact!
-            move_dir = np.random.rand(3)
-            move_dir /= np.linalg.norm(move_dir)
-            tri_id, _, locs = ray_piercing_fun(orig + tol * move_dir)
-            return get_piercings_frompt_lengths(locs, tri_id // 4)
+        _, tri_id, t = tree.intersect(orig[np.newaxis, :], p)
+        locs = orig[np.newaxis, :] + t[:, np.newaxis] * p[np.newaxis, :]
+        return get_piercings_frompt_lengths(locs, tri_id // 4)
 
     # ray_ids_generator = (ray_id_fun(orig) for orig in ray_origins)
     piercings_list = [get_piercings_item(orig) for orig in tqdm(ray_origins)]
     return piercings_list
 
 
+def get_points_piercings_batched(ray_origins, p, triangles, chunk_size=4096, tree=None, n_jobs=1, executor=None):
+    """Batched version of get_points_piercings. The bounding volume hierarchy of the triangles is built once
+    and the rays are then traced through it in chunks of chunk_size in compiled kernels.
+
+    Args:
+        ray_origins ((n,3) array): Origins of the rays
+        p ((3,) array): Ray vector
+        triangles ((n,3,3) array): Triangles. Not used if tree is given.
+        chunk_size (int, optional): Number of rays traced in one pass. Defaults to 4096.
+        tree (BVH, optional): Bounding volume hierarchy of the triangles (e.g. Mesh.bvh). Built if not given. Defaults to None.
+        n_jobs (int, optional): Number of threads tracing the chunks. -1 uses all the cores. Defaults to 1.
+        executor (concurrent.futures.Executor, optional): Executor for tracing the chunks instead of n_jobs threads. Defaults to None.
+
+    Returns:
+        list: piercings list
+    """
+    ray_id, tetra_id, lengths = get_points_segments(ray_origins, p, triangles, chunk_size=chunk_size,
+                                                    tree=tree, n_jobs=n_jobs, executor=executor)
+    return split_piercings(ray_id, tetra_id, lengths, len(ray_origins))
+
+
+def get_points_segments(ray_origins, p, triangles, chunk_size=4096, tree=None, n_jobs=1, executor=None):
+    """Gets the segments of the rays going through the tetrahedra as flat arrays, tracing the rays in chunks (see get_points_piercings_batched).
+
+    Returns:
+        tuple: ray indices ((k,) array), tetra indices ((k,) array) and lengths ((k,) array) of the segments sorted by ray and tetra.
+    """
+    ray_origins = np.asanyarray(ray_origins, dtype=np.float64)
+    p = np.asanyarray(p, dtype=np.float64) / np.linalg.norm(p)
+    if tree is None:
+        tree = BVH.from_triangles(triangles)
+
+    def trace_chunk(start, stop):
+        index_ray, index_tri, t = tree.intersect(
+            ray_origins[start:stop], p, chunk_size=chunk_size)
+        return pair_tetra_hits(index_ray + start, index_tri // 4, t)
+
+    return concatenate_chunks(map_chunks(
+        trace_chunk, ray_origins.shape[0], chunk_size, n_jobs=n_jobs, executor=executor), 3)
+
+
+def map_chunks(fun, n, chunk_size, n_jobs=1, executor=None):
+    """Applies fun(start, stop) to the consecutive chunks of range(n) and returns the results in the order of the chunks.
+    The chunks are run in n_jobs threads or submitted to the executor, so they all share the arrays that fun refers to.
+
+    Args:
+        fun (callable): Function of the start and the stop of the chunk.
+        n (int): Total number of items.
+        chunk_size (int): Number of items in a chunk.
+        n_jobs (int, optional): Number of threads. -1 uses all the cores. Defaults to 1.
+        executor (concurrent.futures.Executor, optional): Executor to use instead of n_jobs threads. Defaults to None.
+
+    Returns:
+        list: Results for each chunk.
+    """
+    starts = list(range(0, n, chunk_size))
+    stops = [min(start + chunk_size, n) for start in starts]
+    if len(starts) == 0:
+        return []
+    if executor is not None:
+        return list(executor.map(fun, starts, stops))
+    if n_jobs == 1 or len(starts) == 1:
+        return [fun(start, stop) for start, stop in zip(starts, stops)]
+    return Parallel(n_jobs=n_jobs, prefer='threads')(
+        delayed(fun)(start, stop) for start, stop in zip(starts, stops))
+
+
+def concatenate_chunks(results, n_arrays):
+    """Concatenates the tuples of arrays returned for each chunk by map_chunks.
+    """
+    if len(results) == 0:
+        return tuple(np.array([], dtype=np.int64) for _ in range(n_arrays))
+    return tuple(np.concatenate(arrs) for arrs in zip(*results))
+
+
+def piercings_to_matrix(piercings, n_tetra):
+    """Converts the piercings list into a sparse matrix of the lengths with a row for each ray and a column for each tetrahedron.
+
+    Args:
+        piercings (list): Piercings list
+        n_tetra (int): Number of tetrahedra in the mesh
+
+    Returns:
+        (n, n_tetra) scipy.sparse.csr_matrix
+    """
+    indptr = np.zeros(len(piercings) + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum([nums.size for _, nums in piercings])
+    if len(piercings) > 0:
+        lengths = np.concatenate([dist for dist, _ in piercings])
+        indices = np.concatenate([nums for _, nums in piercings])
+    else:
+        lengths = np.array([], dtype=np.float64)
+        indices = np.array([], dtype=np.int64)
+    return sparse.csr_matrix((lengths, indices, indptr), shape=(len(piercings), n_tetra))
+
+
+def segments_to_matrix(ray_id, tetra_id, lengths, n_rays, n_tetra):
+    """Converts the flat arrays of segments sorted by ray into a sparse matrix of the lengths with a row for each ray and a column for each tetrahedron.
+
+    Returns:
+        (n_rays, n_tetra) scipy.sparse.csr_matrix
+    """
+    indptr = np.searchsorted(ray_id, np.arange(n_rays + 1))
+    return sparse.csr_matrix((lengths, tetra_id, indptr), shape=(n_rays, n_tetra))
+
+
+def matrix_to_piercings(piercings_matrix):
+    """Converts the sparse matrix of the piercings back into the piercings list.
+    """
+    indptr = piercings_matrix.indptr
+    return [(piercings_matrix.data[indptr[i]:indptr[i + 1]], piercings_matrix.indices[indptr[i]:indptr[i + 1]])
+            for i in range(piercings_matrix.shape[0])]
+
+
+def split_piercings(ray_id, tetra_id, lengths, n_rays):
+    """Splits the flat arrays of segments sorted by ray into the list of per-ray tuples (lengths, tetra_indices).
+    """
+    splits = np.searchsorted(ray_id, np.arange(1, n_rays))
+    return list(zip(np.split(lengths, splits), np.split(tetra_id, splits)))
+
+
+def pair_tetra_hits(index_ray, index_tetra, t):
+    """Pairs up the ray hits of the tetrahedra faces into the segments going through the tetrahedra.
+    A ray going through an edge or a vertex of a tetrahedron hits all the faces sharing it at the same point, 
+    so a tetrahedron can be hit more than twice. Since the tetrahedra are convex, the segment always goes from the first to the last hit.
+    Tetrahedra hit only once are only touched by the ray and are left out.
+
+    Args:
+        index_ray ((h,) array): Index of the ray for each hit.
+        index_tetra ((h,) array): Index of the tetrahedron for each hit.
+        t ((h,) array): Distance along the ray for each hit.
+
+    Returns:
+        tuple: ray indices ((k,) array), tetra indices ((k,) array) and lengths ((k,) array) of the segments sorted by ray and tetra.
+    """
+    order = np.lexsort((t, index_tetra, index_ray))
+    index_ray, index_tetra, t = index_ray[order], index_tetra[order], t[order]
+    # start of each (ray, tetra) group
+    new_group = np.ones(index_ray.size, dtype=bool)
+    new_group[1:] = (index_ray[1:] != index_ray[:-1]) | (
+        index_tetra[1:] != index_tetra[:-1])
+    starts = np.flatnonzero(new_group)
+    ends = np.append(starts[1:], index_ray.size) - 1
+    pierced = ends > starts
+    starts, ends = starts[pierced], ends[pierced]
+    return index_ray[starts], index_tetra[starts], t[ends] - t[starts]
+
+
+def get_points_piercings_walk(ray_origins, p, points, tetra, neighbours, chunk_size=4096, n_jobs=1, executor=None):
+    """Gets the ray piercings by walking through the mesh from one tetrahedron to its neighbour.
+    The rays are intersected only with the faces on the edge of the mesh to find where they enter the mesh.
+    From there, the exit face and the segment length in each tetrahedron are computed in a compiled kernel and the ray moves on to the tetrahedron sharing the exit face,
+    until it leaves the mesh. The cost is proportional to the number of the tetrahedra crossed.
+
+    Args:
+        ray_origins ((n,3) array): Origins of the rays
+        p ((3,) array): Ray vector
+        points ((m,3) array): Points of the mesh
+        tetra ((k,4) array): Tetrahedra of the mesh
+        neighbours ((k,4) array): Face-sharing adjacency of the tetrahedra (see Mesh.tetra_neighbours)
+        chunk_size (int, optional): Number of rays traced in one pass. Defaults to 4096.
+        n_jobs (int, optional): Number of threads tracing the chunks. -1 uses all the cores. Defaults to 1.
+        executor (concurrent.futures.Executor, optional): Executor for tracing the chunks instead of n_jobs threads. Defaults to None.
+
+    Returns:
+        list: piercings list
+    """
+    ray_id, tetra_id, lengths = get_points_segments_walk(ray_origins, p, points, tetra, neighbours,
+                                                         chunk_size=chunk_size, n_jobs=n_jobs, executor=executor)
+    return split_piercings(ray_id, tetra_id, lengths, len(ray_origins))
+
+
+def get_points_segments_walk(ray_origins, p, points, tetra, neighbours, chunk_size=4096, n_jobs=1, executor=None):
+    """Gets the segments of the rays going through the tetrahedra as flat arrays, walking through the mesh (see get_points_piercings_walk).
+
+    Returns:
+        tuple: ray indices ((k,) array), tetra indices ((k,) array) and lengths ((k,) array) of the segments sorted by ray and tetra.
+    """
+    ray_origins = np.asanyarray(ray_origins, dtype=np.float64)
+    p = np.asanyarray(p, dtype=np.float64) / np.linalg.norm(p)
+    points = np.asanyarray(points, dtype=np.float64)
+    # the indices keep their dtype to avoid copies of the compact meshes
+    tetra = np.asanyarray(tetra)
+    neighbours = np.asanyarray(neighbours)
+    tree, edge_tetra = get_mesh_entry_tree(p, points, tetra, neighbours)
+    eps = trimesh_tol.merge * np.max(np.ptp(points, axis=0)) if points.shape[0] > 0 else 0.
+
+    def trace_chunk(start, stop):
+        ray_id, tetra_id, t = get_mesh_entries(
+            ray_origins[start:stop], p, tree, edge_tetra, eps)
+        starts, counts = count_tetra_walk(
+            ray_origins[start:stop], p, points, tetra, neighbours, ray_id, tetra_id, t, eps)
+        ray_id, tetra_id, lengths = tetra_walk(
+            ray_origins[start:stop], p, points, tetra, neighbours, ray_id, tetra_id, starts, counts)
+        return ray_id + start, tetra_id, lengths
+
+    ray_id, tetra_id, lengths = concatenate_chunks(map_chunks(
+        trace_chunk, ray_origins.shape[0], chunk_size, n_jobs=n_jobs, executor=executor), 3)
+
+    # a tetrahedron can appear twice for a ray only if the ray touches it at an edge, so merge those
+    order = np.lexsort((tetra_id, ray_id))
+    ray_id, tetra_id, lengths = ray_id[order], tetra_id[order], lengths[order]
+    new_group = np.ones(ray_id.size, dtype=bool)
+    new_group[1:] = (ray_id[1:] != ray_id[:-1]) | (
+        tetra_id[1:] != tetra_id[:-1])
+    starts = np.flatnonzero(new_group)
+    lengths = np.add.reduceat(lengths, starts) if starts.size > 0 else lengths
+    ray_id, tetra_id = ray_id[starts], tetra_id[starts]
+    nonzero = lengths > 0
+    return ray_id[nonzero], tetra_id[nonzero], lengths[nonzero]
+
+
+def get_mesh_entry_tree(p, points, tetra, neighbours):
+    """Gets the bounding volume hierarchy of the faces on the edge of the mesh through which the rays along p enter the mesh.
+
+    Returns:
+        tuple: BVH of the entry faces, indices of the tetrahedra of the entry faces ((h,) array)
+    """
+    edge_face_id = np.flatnonzero(neighbours.ravel() == -1)
+    edge_tetra = edge_face_id // 4
+    # the face opposite to vertex i has the other three vertices
+    face_vertices = np.array([[1, 2, 3], [0, 2, 3], [0, 1, 3], [0, 1, 2]])
+    faces = tetra[edge_tetra[:, np.newaxis],
+                  face_vertices[edge_face_id % 4]]
+    triangles = points[faces]
+    opposite = points[tetra[edge_tetra, edge_face_id % 4]]
+    normals = np.cross(triangles[:, 1, :] - triangles[:, 0, :],
+                       triangles[:, 2, :] - triangles[:, 0, :])
+    # orient the normals to point out of the tetrahedra
+    outward = np.einsum('ij,ij->i', normals,
+                        triangles[:, 0, :] - opposite) > 0
+    entering = (normals.dot(p) > 0) != outward
+    return BVH.from_triangles(triangles[entering]), edge_tetra[entering]
+
+
+def get_mesh_entries(ray_origins, p, tree, edge_tetra, eps):
+    """Finds where the rays enter the mesh through its edge faces. A ray can enter a non-convex mesh multiple times.
+
+    Args:
+        ray_origins ((n,3) array): Origins of the rays
+        p ((3,) array): Ray vector
+        tree (BVH): Bounding volume hierarchy of the entry faces (see get_mesh_entry_tree)
+        edge_tetra ((h,) array): Indices of the tetrahedra of the entry faces
+        eps (float): Distance along the ray below which the hits are considered the same
+
+    Returns:
+        tuple: ray indices ((h,) array), indices of the entered tetrahedra ((h,) array) and the distances along the rays ((h,) array), sorted by ray and distance.
+    """
+    index_ray, index_tri, t = tree.intersect(
+        ray_origins, p, chunk_size=max(ray_origins.shape[0], 1))
+    index_tetra = edge_tetra[index_tri]
+    order = np.lexsort((t, index_ray))
+    index_ray, index_tetra, t = index_ray[order], index_tetra[order], t[order]
+    # a ray through an edge or a vertex hits several faces at the same point, keep only one of them
+    duplicate = np.zeros(index_ray.size, dtype=bool)
+    duplicate[1:] = (index_ray[1:] == index_ray[:-1]) & (
+        np.abs(t[1:] - t[:-1]) <= eps)
+    return index_ray[~duplicate], index_tetra[~duplicate], t[~duplicate]
+
+
+@njit(cache=True, nogil=True)
+def _tetra_exit(ray_origin, p, points, tetra_vertices):
+    """Gets the entry and exit distances along the ray through the tetrahedron and the index of the exit face (opposite to that vertex).
+    """
+    t_in = -np.inf
+    t_out = np.inf
+    exit_face = -1
+    for i in range(4):
+        a = points[tetra_vertices[(i + 1) % 4]]
+        b = points[tetra_vertices[(i + 2) % 4]]
+        c = points[tetra_vertices[(i + 3) % 4]]
+        d = points[tetra_vertices[i]]
+        normal = np.cross(b - a, c - a)
+        norm = np.sqrt(np.sum(normal**2))
+        if norm == 0:
+            continue
+        normal /= norm
+        # orient the normal to point out of the tetrahedron
+        if np.dot(normal, a - d) < 0:
+            normal = -normal
+        denom = np.dot(normal, p)
+        if abs(denom) < 1e-12:
+            continue
+        t = np.dot(normal, a - ray_origin) / denom
+        if denom > 0:
+            if t < t_out:
+                t_out = t
+                exit_face = i
+        elif t > t_in:
+            t_in = t
+    return t_in, t_out, exit_face
+
+
+@njit(cache=True, nogil=True)
+def count_tetra_walk(ray_origins, p, points, tetra, neighbours, ray_id, tetra_id, t, eps):
+    """Counts the number of tetrahedra crossed by the walk starting from each of the mesh entries.
+    Entries already passed (by more than eps) by the previous walk of the same ray are skipped.
+    Returns the start of each walk in the output arrays and the number of tetrahedra crossed.
+    """
+    n = ray_id.shape[0]
+    counts = np.zeros(n, dtype=np.int64)
+    max_steps = tetra.shape[0]
+    t_reached = -np.inf
+    for j in range(n):
+        if j == 0 or ray_id[j] != ray_id[j - 1]:
+            t_reached = -np.inf
+        if t[j] < t_reached - eps:
+            continue
+        k = tetra_id[j]
+        orig = ray_origins[ray_id[j]]
+        steps = 0
+        while k >= 0 and steps < max_steps:
+            _, t_out, exit_face = _tetra_exit(orig, p, points, tetra[k])
+            steps += 1
+            if exit_face < 0:
+                break
+            t_reached = t_out
+            k = neighbours[k, exit_face]
+        counts[j] = steps
+    starts = np.zeros(n + 1, dtype=np.int64)
+    starts[1:] = np.cumsum(counts)
+    return starts, counts
+
+
+@njit(cache=True, nogil=True)
+def tetra_walk(ray_origins, p, points, tetra, neighbours, ray_id, tetra_id, starts, counts):
+    """Walks through the mesh from each of the mesh entries and records the crossed tetrahedra and the lengths of the segments through them.
+    """
+    n_total = starts[-1]
+    out_ray = np.empty(n_total, dtype=np.int64)
+    out_tetra = np.empty(n_total, dtype=np.int64)
+    out_lengths = np.zeros(n_total, dtype=np.float64)
+    for j in range(ray_id.shape[0]):
+        k = tetra_id[j]
+        orig = ray_origins[ray_id[j]]
+        for s in range(starts[j], starts[j] + counts[j]):
+            t_in, t_out, exit_face = _tetra_exit(orig, p, points, tetra[k])
+            out_ray[s] = ray_id[j]
+            out_tetra[s] = k
+            if exit_face < 0:
+                break
+            out_lengths[s] = max(t_out - t_in, 0.)
+            k = neighbours[k, exit_face]
+    return out_ray, out_tetra, out_lengths
+
+
 # @njit()
 def get_piercings_frompt_lengths(locations, intersected_tetrahedra_indx):
     """Gets the lengths and the unique index of intersected tetrahedra.
-    I.e. from the locations of intersections and the indices of intersected tetrahedra, get the tetrahedra that were pierced twice and the length of the intersection segment.
+    I.e. from the locations of intersections and the indices of intersected tetrahedra, get the tetrahedra that were pierced and the length of the intersection segment.
+    A ray through an edge or a vertex hits the tetrahedron more than twice at the same points, so the length is the distance between the furthest apart hits.
+    Tetrahedra hit only once are only touched by the ray and are left out.
     """
     intersected_tetrahedra_indx_unique = np.unique(intersected_tetrahedra_indx)
     intersected_tetrahedra_lengths = np.zeros(
         intersected_tetrahedra_indx_unique.size)
     for i, idx in enumerate(intersected_tetrahedra_indx_unique):
         pts = locations[intersected_tetrahedra_indx == idx]
-        if pts.shape[0] != 2:
-            # this could be improved. Instead of giving an error, it should deal with the numerical artefacts
-            # continue
-            raise ValueError(
-                'Wrong number of intersections! Ensure that tetrahedra are valid and that the projection plane does not intersect the structure.')
-        intersected_tetrahedra_lengths[i] = np.linalg.norm(
-            pts[0, :] - pts[1, :])
-    return (intersected_tetrahedra_lengths, intersected_tetrahedra_indx_unique)
+        # the points are on a line, so the furthest point from any of them is an end of the segment
+        end = pts[np.argmax(np.linalg.norm(pts - pts[0, :], axis=1)), :]
+        intersected_tetrahedra_lengths[i] = np.max(
+            np.linalg.norm(pts - end, axis=1))
+    pierced = np.array([np.sum(intersected_tetrahedra_indx == idx) > 1
+                        for idx in intersected_tetrahedra_indx_unique], dtype=bool)
+    return (intersected_tetrahedra_lengths[pierced], intersected_tetrahedra_indx_unique[pierced])
 
 
 # THIS IS COPIED FROM TRIMESH LIBRARY, BUT I NEEDED TO EDIT THE LAST BIT WHERE THEY FILTER OUT FOR THE SIDE OF THE PLANE.
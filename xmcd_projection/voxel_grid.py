@@ -0,0 +1,421 @@
+import meshio
+import numpy as np
+import trimesh
+from cached_property import cached_property
+from numba import njit
+from scipy import sparse
+
+from .data_loading import load_ovf
+from .mesh import Mesh, Pose
+from .raytracing import RayTracing, map_chunks, concatenate_chunks, segments_to_matrix
+
+
+class VoxelGrid(Pose):
+    """Regular grid of cubic cells, e.g. a mumax simulation. Only the filled cells (inside the magnet) are traced.
+    The filled cells are numbered in the C order of the grid.
+    The cells are the simulation cells, with the origin at their corner as in the .ovf files, and the points
+    (e.g. of the .vtu file exported from mumax) are at the centres of the cells, each carrying the magnetisation of its cell.
+
+        Args:
+            origin ((3,) array): Corner of the grid.
+            spacing ((3,) array): Size of the cells.
+            shape ((3,) array): Number of cells along each axis.
+            mask ((nx,ny,nz) array, optional): True for the filled cells. Defaults to None (all the cells are filled).
+            points ((n,3) array, optional): Points at the centres of the cells, carrying the per-cell magnetisation.
+                Defaults to None (the centres of all the cells of the grid in the C order).
+    """
+
+    def __init__(self, origin, spacing, shape, mask=None, points=None):
+        self.origin = np.asarray(origin, dtype=np.float64)
+        self.spacing = np.asarray(spacing, dtype=np.float64) * np.ones(3)
+        self.shape = np.asarray(shape, dtype=np.int64)
+        self.mask = np.ones(self.shape, dtype=bool) if mask is None else np.asarray(
+            mask, dtype=bool)
+        if points is not None:
+            self.points = points
+
+    @classmethod
+    def from_file(cls, file_path, scale=1, empty_field=None):
+        """Creates the grid from the .vtu file exported from mumax (see Mesh.from_file). The points of the file are the centres of the cells,
+        so the grid extends half a cell beyond the cubes of the .vtu mesh joining them, and lines up with the grid of the .ovf files (see from_ovf).
+
+        Args:
+            file_path (str)
+            scale (float, optional): Scale for the coordinates. Defaults to 1.
+            empty_field (str, optional): Cell or point data used to find the cells outside the magnet (see Mesh.get_filled_points). Defaults to None.
+
+        Returns:
+            VoxelGrid
+        """
+        msh = meshio.read(file_path)
+        points = msh.points * scale
+        filled_points = Mesh.get_filled_points(msh, empty_field)
+        extent = np.ptp(points, axis=0)
+        # the smallest distance between the coordinates along each axis is the cell size
+        spacing = np.ones(3)
+        for k in range(3):
+            steps = np.diff(np.unique(points[:, k]))
+            steps = steps[steps > 1e-6 * extent[k]]
+            spacing[k] = steps.min() if steps.size > 0 else 1.
+        n_steps = np.round(extent / spacing).astype(np.int64)
+        spacing = np.where(extent > 0, extent / np.maximum(n_steps, 1), spacing)
+        origin = points.min(axis=0) - spacing / 2
+        grid = cls(origin, spacing, n_steps + 1, mask=np.zeros(n_steps + 1, dtype=bool),
+                   points=points)
+        grid.mask[tuple(grid.point_cell_index[filled_points].T)] = True
+        return grid
+
+    @classmethod
+    def from_ovf(cls, file_path, scale=1):
+        """Creates the grid from the header of the OOMMF/mumax .ovf file. The non-zero cells of the file are the filled cells,
+        so the values from load_ovf of this and the other time steps can be projected directly with VoxelRayTracing.get_xmcd_cells.
+
+        Args:
+            file_path (str)
+            scale (float, optional): Scale for the coordinates. Defaults to 1.
+
+        Returns:
+            VoxelGrid
+        """
+        values, header = load_ovf(file_path)
+        origin = np.array([header['xmin'], header['ymin'],
+                           header['zmin']]) * scale
+        spacing = np.array([header['xstepsize'], header['ystepsize'],
+                            header['zstepsize']]) * scale
+        return cls(origin, spacing, values.shape[:3], mask=np.any(values != 0, axis=3))
+
+    @cached_property
+    def points(self):
+        """Points at the centres of the cells.
+
+        Returns:
+            (n,3) array
+        """
+        cells = np.array(np.unravel_index(
+            np.arange(np.prod(self.shape)), self.shape)).T
+        return self.origin + (cells + 0.5) * self.spacing
+
+    def get_cell_index(self, points):
+        """Gets the indices of the grid cells containing the points.
+
+        Args:
+            points ((n,3) array): Points in the frame of the grid, e.g. the centres of the cells.
+
+        Returns:
+            (n,3) array
+        """
+        return np.clip(np.floor((np.asanyarray(points) - self.origin) / self.spacing).astype(np.int64),
+                       0, self.shape - 1)
+
+    @cached_property
+    def point_cell_index(self):
+        """Indices of the grid cells of the points.
+
+        Returns:
+            (n,3) array
+        """
+        return self.get_cell_index(self.points)
+
+    @cached_property
+    def cell_points(self):
+        """Index of the point in each cell of the grid, or -1 if there is none.
+
+        Returns:
+            (nx,ny,nz) array
+        """
+        cell_points = np.full(self.shape, -1, dtype=np.int64)
+        cell_points[tuple(self.point_cell_index.T)] = np.arange(
+            self.points.shape[0])
+        return cell_points
+
+    @cached_property
+    def cell_index(self):
+        """Index of each cell among the filled cells, or -1 for the empty cells.
+
+        Returns:
+            (nx,ny,nz) array
+        """
+        cell_index = np.full(self.shape, -1, dtype=np.int64)
+        cell_index[self.mask] = np.arange(np.count_nonzero(self.mask))
+        return cell_index
+
+    @property
+    def n_cells(self):
+        return int(np.count_nonzero(self.mask))
+
+    @cached_property
+    def cell_averaging_operator(self):
+        """Sparse matrix taking the per-point values of the filled cells from the points at their centres.
+
+        Returns:
+            (n_cells, n_points) scipy.sparse.csr_matrix
+        """
+        cell_points = self.cell_points[self.mask]
+        if np.any(cell_points < 0):
+            raise ValueError("Not all the filled cells have a point at the centre!")
+        return sparse.csr_matrix((np.ones(cell_points.size), (np.arange(cell_points.size), cell_points)),
+                                 shape=(cell_points.size, self.points.shape[0]))
+
+    def get_tetra_values(self, values):
+        """Gets the per-point values (e.g. magnetisation) of the filled cells using cell_averaging_operator (see Mesh.get_tetra_values).
+
+        Args:
+            values ((n,...) array): Per-point values, e.g. (n,3) magnetisation or (n,3,k) stack of frames.
+
+        Returns:
+            (n_cells,...) array
+        """
+        values = np.asanyarray(values)
+        flat = values.reshape(values.shape[0], -1)
+        return (self.cell_averaging_operator @ flat).reshape((-1,) + values.shape[1:])
+
+    def get_shuffle_indx(self, points):
+        """Finds the indices such that points[shuffle_indx, :] = self.points by finding the cells of the points (see Mesh.get_shuffle_indx).
+
+        Args:
+            points ((n, 3) array): Points to be shuffled.
+
+        Returns:
+            (n,) array: Indices of the shuffled array
+        """
+        cell_to_points = np.full(self.shape, -1, dtype=np.int64)
+        cell_to_points[tuple(self.get_cell_index(points).T)] = np.arange(
+            np.asanyarray(points).shape[0])
+        return cell_to_points[tuple(self.point_cell_index.T)]
+
+    def get_cell_values(self, values):
+        """Gets the values of the filled cells from the values of the whole grid.
+
+        Args:
+            values ((nx,ny,nz,...) or (n_cells,...) array)
+
+        Returns:
+            (n_cells,...) array
+        """
+        values = np.asanyarray(values)
+        if values.shape[:3] == tuple(self.shape):
+            return values[self.mask]
+        return values
+
+    def get_bounding_struct(self, fix=False):
+        """Faces of the filled cells bordering the empty cells or the edge of the grid, split into triangles with outward normals.
+        """
+        quads = []
+        for axis in range(3):
+            padded = np.pad(self.mask, [(1, 1) if k == axis else (0, 0)
+                                        for k in range(3)])
+            change = np.diff(padded.astype(np.int8), axis=axis)
+            for sign in (-1, 1):
+                # sign -1: filled cell below the face, the normal points along the axis
+                face_idx = np.argwhere(change == sign)
+                # the other two axes in the right handed order
+                u, v = (axis + 1) % 3, (axis + 2) % 3
+                du, dv = np.eye(3, dtype=np.int64)[u], np.eye(3, dtype=np.int64)[v]
+                corners = np.stack([face_idx, face_idx + du,
+                                    face_idx + du + dv, face_idx + dv], axis=1)
+                if sign == 1:
+                    corners = corners[:, ::-1]
+                quads.append(corners)
+        quads = np.concatenate(quads)
+        flat_nodes = np.ravel_multi_index(
+            quads.reshape(-1, 3).T, self.shape + 1)
+        node_ids, quads = np.unique(flat_nodes, return_inverse=True)
+        quads = quads.reshape(-1, 4)
+        vertices = self.origin + \
+            np.array(np.unravel_index(node_ids, self.shape + 1)).T * self.spacing
+        if self.is_posed:
+            vertices = vertices.dot(self.rotation.T) + self.translation
+        faces = np.vstack([quads[:, [0, 1, 2]], quads[:, [0, 2, 3]]])
+        struct = trimesh.Trimesh(vertices=vertices, faces=faces, process=False)
+        if fix:
+            trimesh.repair.fix_winding(struct)
+            trimesh.repair.fix_inversion(struct)
+        return struct
+
+
+class VoxelRayTracing(RayTracing):
+    """Raytracing of a VoxelGrid. The rays are traced through the cells with a 3D digital differential analyser
+    (Amanatides & Woo), so the lengths in the cells are computed directly from the grid without any tetrahedra.
+    The per-point magnetisation is taken from the points at the centres of the cells, and per-cell magnetisation
+    (e.g. read from the mumax .ovf files) can be projected with get_xmcd_cells.
+
+        Args:
+            grid (VoxelGrid)
+            p ((3,) array): Beam direction vector.
+            n ((3,), optional): Normal to the projection plane. Defaults to [0, 0, 1].
+            x0 ((3,), optional): Point on the projection plane. Defaults to the minimum point of the filled cells in the n direction.
+            tol (float, optional): Tolerance for numerical errors. Defaults to 1e-5.
+            n_jobs (int, optional): Number of threads tracing the chunks of rays. -1 uses all the cores. Defaults to 1.
+            executor (concurrent.futures.Executor, optional): Executor for tracing the chunks of rays instead of n_jobs threads. Defaults to None.
+    """
+
+    def __init__(self, grid, p, n=[0, 0, 1], x0=None, tol=1e-5, n_jobs=1, executor=None):
+        if x0 is None:
+            # corner of the filled cells the most in the negative n direction
+            n_unit = np.array(n) / np.linalg.norm(n)
+            n_grid = grid.direction_to_mesh_frame(n_unit)
+            cell_min = np.min((np.argwhere(grid.mask) * grid.spacing).dot(n_grid)) + \
+                np.sum(np.minimum(grid.spacing * n_grid, 0))
+            x0 = (grid.origin.dot(n_grid) + cell_min +
+                  grid.translation.dot(n_unit) - tol) * n_unit
+        super().__init__(grid, p, n=n, x0=x0, tol=tol,
+                         n_jobs=n_jobs, executor=executor)
+        self.method = 'dda'
+
+    @property
+    def averaging_operator(self):
+        """Sparse matrix taking the per-point values of the filled cells (see VoxelGrid.cell_averaging_operator).
+
+        Returns:
+            (n_cells, n_vertices) scipy.sparse.csr_matrix
+        """
+        return self.mesh.cell_averaging_operator
+
+    def trace_rays(self, ray_origins, chunk_size=4096):
+        """Traces the rays with direction self.p from the given origins through the filled cells of the grid.
+
+        Args:
+            ray_origins ((m,3) array): Origins of the rays.
+            chunk_size (int, optional): Number of rays traced in one pass. Defaults to 4096.
+
+        Returns:
+            (m, n_cells) scipy.sparse.csr_matrix: Element [i, j] is the length of the ray i going through the filled cell j.
+        """
+        grid = self.mesh
+        p = np.ascontiguousarray(
+            self.pose.direction_to_mesh_frame(self.p), dtype=np.float64)
+        ray_origins = np.ascontiguousarray(
+            self.pose.to_mesh_frame(ray_origins), dtype=np.float64)
+        cell_index = grid.cell_index
+
+        def trace_chunk(start, stop):
+            counts = _dda_count(ray_origins[start:stop], p, grid.origin,
+                                grid.spacing, cell_index)
+            ray_id, cell_id, lengths = _dda_fill(ray_origins[start:stop], p, grid.origin,
+                                                 grid.spacing, cell_index, counts)
+            return ray_id + start, cell_id, lengths
+
+        segments = concatenate_chunks(map_chunks(trace_chunk, ray_origins.shape[0], chunk_size,
+                                                 n_jobs=self.n_jobs, executor=self.executor), 3)
+        return segments_to_matrix(*segments, ray_origins.shape[0], grid.n_cells)
+
+    def get_xmcd_cells(self, magnetisation):
+        """Gets the xmcd data from the per-cell magnetisation.
+
+        Args:
+            magnetisation ((nx,ny,nz,3) or (n_cells,3) array): magnetization of the whole grid or of the filled cells.
+
+        Returns:
+            (m,) array: XMCD value for each face of the projected structure.
+        """
+        mag_p = self.mesh.get_cell_values(magnetisation).dot(self.p)
+        return self.piercings_matrix @ mag_p
+
+
+@njit(cache=True, nogil=True)
+def _dda_start(origin, direction, grid_origin, spacing, shape):
+    """Finds the entry and the exit of the line into the grid. Returns nan if the line misses the grid.
+    """
+    t_min = -np.inf
+    t_max = np.inf
+    for k in range(3):
+        lo = grid_origin[k]
+        hi = grid_origin[k] + shape[k] * spacing[k]
+        if direction[k] == 0:
+            if origin[k] < lo or origin[k] > hi:
+                return np.nan, np.nan
+        else:
+            t1 = (lo - origin[k]) / direction[k]
+            t2 = (hi - origin[k]) / direction[k]
+            if t1 > t2:
+                t1, t2 = t2, t1
+            t_min = max(t_min, t1)
+            t_max = min(t_max, t2)
+    if t_min >= t_max:
+        return np.nan, np.nan
+    return t_min, t_max
+
+
+@njit(cache=True, nogil=True)
+def _dda_walk(origin, direction, grid_origin, spacing, cell_index, out_cell, out_length):
+    """Walks the line through the cells of the grid from its entry to its exit.
+    Writes the filled cells and the lengths in them to the output arrays if they are long enough, and returns the number of the crossed filled cells.
+    """
+    shape = cell_index.shape
+    t, t_exit = _dda_start(origin, direction, grid_origin, spacing, shape)
+    if np.isnan(t):
+        return 0
+    idx = np.zeros(3, dtype=np.int64)
+    step = np.zeros(3, dtype=np.int64)
+    t_next = np.full(3, np.inf)
+    t_delta = np.full(3, np.inf)
+    for k in range(3):
+        # cell of the point in the middle of the first step, away from the edge of the grid
+        x = origin[k] + t * direction[k]
+        i = int(np.floor((x - grid_origin[k]) / spacing[k]))
+        if direction[k] < 0 and x - grid_origin[k] == i * spacing[k]:
+            i -= 1
+        idx[k] = min(max(i, 0), shape[k] - 1)
+        if direction[k] > 0:
+            step[k] = 1
+            t_delta[k] = spacing[k] / direction[k]
+            t_next[k] = (grid_origin[k] + (idx[k] + 1) *
+                         spacing[k] - origin[k]) / direction[k]
+        elif direction[k] < 0:
+            step[k] = -1
+            t_delta[k] = -spacing[k] / direction[k]
+            t_next[k] = (grid_origin[k] + idx[k] *
+                         spacing[k] - origin[k]) / direction[k]
+    n = 0
+    while True:
+        k = 0
+        if t_next[1] < t_next[k]:
+            k = 1
+        if t_next[2] < t_next[k]:
+            k = 2
+        t_end = min(t_next[k], t_exit)
+        cell = cell_index[idx[0], idx[1], idx[2]]
+        if cell >= 0 and t_end > t:
+            if out_cell.shape[0] > 0:
+                out_cell[n] = cell
+                out_length[n] = t_end - t
+            n += 1
+        if t_next[k] >= t_exit:
+            break
+        t = t_end
+        idx[k] += step[k]
+        if idx[k] < 0 or idx[k] >= shape[k]:
+            break
+        t_next[k] += t_delta[k]
+    return n
+
+
+@njit(cache=True, nogil=True)
+def _dda_count(ray_origins, direction, grid_origin, spacing, cell_index):
+    """Counts the filled cells crossed by each ray.
+    """
+    counts = np.zeros(ray_origins.shape[0], dtype=np.int64)
+    empty_cell = np.zeros(0, dtype=np.int64)
+    empty_length = np.zeros(0, dtype=np.float64)
+    for i in range(ray_origins.shape[0]):
+        counts[i] = _dda_walk(ray_origins[i], direction, grid_origin, spacing,
+                              cell_index, empty_cell, empty_length)
+    return counts
+
+
+@njit(cache=True, nogil=True)
+def _dda_fill(ray_origins, direction, grid_origin, spacing, cell_index, counts):
+    """Fills the crossed filled cells and the lengths in them for all the rays.
+    """
+    n_hits = counts.sum()
+    ray_id = np.empty(n_hits, dtype=np.int64)
+    cell_id = np.empty(n_hits, dtype=np.int64)
+    lengths = np.empty(n_hits, dtype=np.float64)
+    start = 0
+    for i in range(ray_origins.shape[0]):
+        stop = start + counts[i]
+        ray_id[start:stop] = i
+        _dda_walk(ray_origins[i], direction, grid_origin, spacing, cell_index,
+                  cell_id[start:stop], lengths[start:stop])
+        start = stop
+    return ray_id, cell_id, lengths